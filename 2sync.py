@@ -1,14 +1,25 @@
 #! /usr/bin/env python3
-from gi.repository import Gtk, GObject
-import gui
 import logging
 import argparse
+import sys
 import threading
+import time
 
 # Commandline arguments
 parser = argparse.ArgumentParser(description='2-way syncronisation for folders')
 parser.add_argument('config', help='name of the configuration file')
 parser.add_argument('-d', '--debug', action='store_true', help='use this option for debuging (write debug messages to logfile)')
+parser.add_argument('--path', action='append', metavar='SUB_PATH', help='read and sync only this directory (relative to the root, e.g. /dir), instead of the path keys of the config (can be used more than once)')
+parser.add_argument('--resume', action='store_true', help='continue the last aborted sync without reading the roots again (no GUI)')
+parser.add_argument('--restore', metavar='SUB_PATH', help='move SUB_PATH (relative to the root, e.g. /dir/file) back from the newest backup (no GUI)')
+parser.add_argument('--backup', metavar='STAMP', help='restore from this backup (YYYYmmdd-HHMMSS) instead of the newest one')
+parser.add_argument('--dry-run', action='store_true', help='print what a sync of all changes without conflict would do and cost, without changing anything (no GUI)')
+parser.add_argument('--plan', metavar='FILE', help='with --dry-run: save the estimate with all operations as json in FILE')
+parser.add_argument('--daemon', action='store_true', help='keep the roots in memory and serve the GUI and the command line over a unix socket')
+parser.add_argument('--changes', action='store_true', help='print the changes known by the running daemon (no GUI)')
+parser.add_argument('--rescan', action='store_true', help='let the running daemon read both roots again (with --changes or --sync)')
+parser.add_argument('--sync', action='store_true', help='sync all changes without conflict over the running daemon (no GUI)')
+parser.add_argument('--stop', action='store_true', help='stop the running daemon')
 args = parser.parse_args()
 
 # Config logging
@@ -25,10 +36,74 @@ console = logging.StreamHandler()
 console.setLevel(logging.WARNING)
 logging.getLogger('').addHandler(console)
 
+if args.resume:
+	from twosync import config, progress, runner
+	sync_progress = progress.Progress()
+	sync_progress.add_listener(progress.print_listener)
+	synced = runner.resume(config.Config(args.config), sync_progress)
+	sync_progress.close()
+	if synced == None:
+		print('No aborted sync to resume')
+		sys.exit(1)
+	sys.exit(0)
+
+if args.restore:
+	from twosync import config, runner
+	stamp = runner.restore(config.Config(args.config), args.restore, args.backup)
+	if stamp == None:
+		print("No backup of '" + args.restore + "'")
+		sys.exit(1)
+	print("Restored '" + args.restore + "' from backup " + stamp)
+	sys.exit(0)
+
+if args.dry_run:
+	import json
+	from twosync import config, estimate, progress, runner
+	report = runner.dry_run(config.Config(args.config, args.path), args.plan != None)
+	print(estimate.format_report(report))
+	if report['conflicts'] > 0:
+		print('%d conflicts are not synced' % report['conflicts'])
+	if report['compared conflicts'] > 0:
+		print('%d conflicts (%s) with the same attributes on both sides are hashed first, resolved if the content is the same'
+			% (report['compared conflicts'], progress.format_size(report['compared bytes'])))
+	if args.plan != None:
+		with open(args.plan, 'w') as f:
+			json.dump(report, f, indent=1)
+	sys.exit(0)
+
+if args.daemon:
+	from twosync import daemon
+	daemon.Daemon(args.config, paths=args.path).serve()
+	sys.exit(0)
+
+if args.changes or args.sync or args.stop:
+	from twosync import daemon, progress, utils
+	client = daemon.Client(args.config)
+	if args.stop:
+		client.stop()
+		sys.exit(0)
+
+	pdata, roots, changes, scanned = client.changes(args.rescan)
+	if args.changes:
+		if not args.rescan:
+			print('Changes as read by the daemon at %s (--rescan reads the roots again)' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(scanned)), file=sys.stderr)
+		for sub_path, change in changes:
+			print('%-8s %s' % (change.name.lower(), sub_path))
+		sys.exit(0)
+
+	items = [(sub_path, 0 if change is utils.ChangeType.FIRST else 1) for sub_path, change in changes if change is not utils.ChangeType.CONFLICT]
+	result = client.sync(items, progress.print_listener)
+	for error in result['errors']:
+		print(error, file=sys.stderr)
+	sys.exit(1 if len(result['errors']) > 0 else 0)
+
+from gi.repository import Gtk, GObject
+import gui
+
 # Needed for running threads
 GObject.threads_init()
 
-thread = threading.Thread(target=gui.TwoSyncGUI, args=[args.config])
+thread = threading.Thread(target=gui.TwoSyncGUI, args=[args.config, args.path])
 thread.daemon = True
 thread.start()
 
@@ -1,8 +1,10 @@
 from gi.repository import Gtk, GLib, GObject
-from twosync import config, data, utils
+from twosync import config, daemon, data, estimate, progress, runner, utils
+import logging
 import threading
 import paramiko
 import socket
+import time
 
 class TSPolicy(paramiko.client.MissingHostKeyPolicy):
 	"""User-defined MissingHostKeyPolicy"""
@@ -35,7 +37,7 @@ class TSPolicy(paramiko.client.MissingHostKeyPolicy):
 			paramiko.client.RejectPolicy().missing_host_key(client, hostname, key)
 
 class MainWin(object):
-	def __init__(self, pdata, roots):
+	def __init__(self, cfg, pdata, roots, client=None):
 		self.builder = Gtk.Builder()
 		self.builder.add_from_file("glade/main_win.glade")
 		self.builder.connect_signals(self)
@@ -56,8 +58,17 @@ class MainWin(object):
 		self.lbl_root0_detail = self.builder.get_object('lbl_root0_detail')
 		self.lbl_root1_detail = self.builder.get_object('lbl_root1_detail')
 
+		self.cfg = cfg
 		self.pdata = pdata
 		self.roots = roots
+		# daemon.Client, if the data is kept by a daemon (pdata and roots are snapshots then)
+		self.client = client
+		# Measured links to remote roots for the estimate of a sync
+		self.links = None
+		# TreeIter of the row of every shown sub_path
+		self.rows = dict()
+		# Title of the window without the state of a refresh
+		self._title = None
 
 	def show_all(self, blocking=False):
 		GLib.idle_add(self.win.show_all)
@@ -82,34 +93,42 @@ class MainWin(object):
 			self.treestore[selection][2] = icon_name
 			self.treeview.grab_focus()
 
+	def get_icon_name(self, sub_path):
+		if self.pdata[sub_path] != self.roots[0][sub_path] and self.pdata[sub_path] == self.roots[1][sub_path]:
+			ico = "go-next"
+		elif self.pdata[sub_path] != self.roots[1][sub_path] and self.pdata[sub_path] == self.roots[0][sub_path]:
+			ico = "go-previous"
+		else:
+			ico = Gtk.STOCK_CLOSE
+
+		return str(ico)
+
+	def get_state(self, sub_path, root):
+		diff = self.pdata[sub_path].diff(root[sub_path])
+		if diff is data.DiffType.NONE:
+			return ""
+		elif diff is data.DiffType.NEW:
+			return "new"
+		elif diff is data.DiffType.REMOVED:
+			return "removed"
+		elif diff is data.DiffType.TYPE:
+			return "file/folder missmatch"
+		elif diff is data.DiffType.MODE:
+			return "Properties changed"
+		elif diff is data.DiffType.MTIME:
+			return "mtime changed or file changed"
+		elif diff is data.DiffType.CONTENT:
+			return "file changed"
+
+	def get_row(self, sub_path):
+		"""
+		Returns the values of the row of sub_path
+		"""
+		return [str(sub_path), self.get_state(sub_path, self.roots[0]), self.get_icon_name(sub_path), self.get_state(sub_path, self.roots[1])]
+
 	def do_update_liststore(self, changes):
 		def _update(self, changes):
-			def get_icon_name(sub_path, pdata, roots):
-				if pdata[sub_path] != roots[0][sub_path] and pdata[sub_path] == roots[1][sub_path]:
-					ico = "go-next"
-				elif pdata[sub_path] != roots[1][sub_path] and pdata[sub_path] == roots[0][sub_path]:
-					ico = "go-previous"
-				else:
-					ico = Gtk.STOCK_CLOSE
-
-				return str(ico)
-
-			def get_state(sub_path, root):
-				diff = self.pdata[sub_path].diff(root[sub_path])
-				if diff is data.DiffType.NONE:
-					return ""
-				elif diff is data.DiffType.NEW:
-					return "new"
-				elif diff is data.DiffType.REMOVED:
-					return "removed"
-				elif diff is data.DiffType.TYPE:
-					return "file/folder missmatch"
-				elif diff is data.DiffType.MODE:
-					return "Properties changed"
-				elif diff is data.DiffType.MTIME:
-					return "mtime changed or file changed"
-				elif diff is data.DiffType.CONTENT:
-					return "file changed"
+			self.rows = dict()
 
 			# update column titles with path
 			GLib.idle_add(self.root0_column.set_title, self.roots[0].path)
@@ -129,7 +148,8 @@ class MainWin(object):
 						stack = stack[:pos]
 						break
 
-				iter_ = self.treestore.insert(parent, -1, [str(change), get_state(change, self.roots[0]), get_icon_name(change, self.pdata, self.roots), get_state(change, self.roots[1])])
+				iter_ = self.treestore.insert(parent, -1, self.get_row(change))
+				self.rows[change] = iter_
 
 				if type(self.roots[0][change]) == data.DataFolderType or type(self.roots[1][change]) == data.DataFolderType:
 					stack.append((change, iter_))
@@ -139,18 +159,114 @@ class MainWin(object):
 
 		GLib.idle_add(_update, self, changes)
 
+	def do_update_rows(self, changes):
+		"""
+		Updates only the rows of the paths in changes (a dictionary with sub_path and ChangeType) instead of the whole tree
+
+		Rows of paths without change are removed (their children are moved up), changed paths without row are added.
+		Scroll position and selection of the other rows are kept.
+		"""
+		def move_children(iter_, parent):
+			child = self.treestore.iter_children(iter_)
+			while child != None:
+				moved = self.treestore.insert(parent, -1, list(self.treestore[child]))
+				self.rows[self.treestore[child][0]] = moved
+				move_children(child, moved)
+				child = self.treestore.iter_next(child)
+
+		def parent_row(sub_path):
+			parent = sub_path.rstrip('/').rsplit('/', 1)[0] + '/'
+			while parent != '/':
+				if parent in self.rows:
+					return self.rows[parent]
+				parent = parent[:-1].rsplit('/', 1)[0] + '/'
+			return None
+
+		def _update(self, changes):
+			# Parents first, new rows need the rows of their parents
+			for sub_path in sorted(changes):
+				iter_ = self.rows.get(sub_path)
+				if changes[sub_path] is utils.ChangeType.NONE:
+					if iter_ != None:
+						move_children(iter_, self.treestore.iter_parent(iter_))
+						self.treestore.remove(iter_)
+						del self.rows[sub_path]
+				elif iter_ != None:
+					self.treestore[iter_] = self.get_row(sub_path)
+				else:
+					self.rows[sub_path] = self.treestore.insert(parent_row(sub_path), -1, self.get_row(sub_path))
+					self.treeview.expand_to_path(self.treestore.get_path(self.rows[sub_path]))
+
+		GLib.idle_add(_update, self, changes)
+
+	def do_refresh(self, scanned):
+		"""
+		Lets the daemon read both roots again in the background and updates the rows, which have changed since
+
+		Until then, the title shows the time of the scan (scanned), the shown changes are based on.
+		"""
+		def set_title(self, state):
+			if self._title == None:
+				self._title = self.win.get_title()
+			self.win.set_title('%s (%s)' % (self._title, state))
+
+		def update(self, pdata, roots, changes):
+			# Rows of paths, which are changed in another way or no longer, are updated (the others keep the direction)
+			datas = [self.pdata] + self.roots
+			updated = dict((sub_path, utils.ChangeType.NONE) for sub_path in self.rows if sub_path not in changes)
+			for sub_path, change in changes.items():
+				if sub_path not in self.rows or [_data[sub_path] for _data in datas] != [_data[sub_path] for _data in [pdata] + roots]:
+					updated[sub_path] = change
+			self.pdata = pdata
+			self.roots = roots
+			self.do_update_rows(updated)
+			self.win.set_title(self._title)
+
+		def refresh():
+			client = self.client.copy()
+			try:
+				pdata, roots, changes, _ = client.changes(rescan=True)
+			except Exception as e:
+				logging.warning("Reading the roots again failed: " + str(e))
+				GLib.idle_add(set_title, self, 'read at %s, reading again failed' % time.strftime('%X', time.localtime(scanned)))
+				return
+			finally:
+				client.close()
+			GLib.idle_add(update, self, pdata, roots, dict(changes))
+
+		GLib.idle_add(set_title, self, 'read at %s, reading again' % time.strftime('%X', time.localtime(scanned)))
+		thread = threading.Thread(target=refresh)
+		thread.daemon = True
+		thread.start()
+
 	def do_sync(self):
-		def update_callback(now, max_, path=None):
+		def update_listener(state):
 			if progress_dlg.dlg.get_visible():
-				progress_dlg.update(path, now/max_)
+				progress_dlg.update(progress.format_state(state), progress.fraction(state))
 			else:
-				raise InterruptedError
+				sync_progress.cancel()
+
+		def on_error(e):
+			if isinstance(e, socket.timeout):
+				error_dlg = ErrorDlg('2sync - Error', 'Connection timeout', progress_dlg.dlg)
+			else:
+				error_dlg = ErrorDlg('2sync - Error', str(e), progress_dlg.dlg)
+			error_dlg.set_btn_close_event(error_dlg.close)
+			error_dlg.run()
+
+		def cancel():
+			if self.client != None:
+				self.client.cancel()
+			elif sync_progress != None:
+				sync_progress.cancel()
+			progress_dlg.close()
 
 		buf = []
 		rows = []
+		sync_progress = None
 
 		progress_dlg = ProgressDlg('2sync - sync data', 'prepare sync', self.win)
-		progress_dlg.set_btn_close_event(progress_dlg.close)
+		progress_dlg.set_btn_close_event(cancel)
 		progress_dlg.show_all()
 
 		progress_dlg.update('prepare', 0.1)
@@ -177,37 +293,73 @@ class MainWin(object):
 			elif row[2] == "go-next":
 				synclist.append((row[0], self.roots[0], self.roots[1]))
 
-		sync = data.SyncData(synclist)
-		synced = []
-		while not sync.finished():
-			try:
-				synced.append(sync.sync_next(update_callback))
-			except InterruptedError:
-				break
+		if self.client != None:
+			self.do_sync_client(synclist, progress_dlg, on_error)
+			return
+
+		progress_dlg.update('compare files with changed mtime', 0.2)
+		sync = data.SyncData(synclist, self.cfg.bundle_size, backup=self.cfg.backup_days > 0, verify=self.cfg.verify,
+			priority=self.cfg.priority, limits=self.cfg.rate_limits)
+		if sync.avoided_bytes > 0:
+			progress_dlg.set_first_text('2sync - sync data (%s not copied, only mtime changed)' % progress.format_size(sync.avoided_bytes))
+		if self.links == None:
+			progress_dlg.update('measure connection', 0.3)
+			self.links = dict((root, root.measure_link()) for root in self.roots if isinstance(root, data.SSHData))
+		report = estimate.estimate(sync, self.links)
+		logging.info("Sync plan: " + estimate.format_report(report).replace('\n', ' - '))
+		confirm_dlg = ConfirmDlg('Sync?', estimate.format_report(report), progress_dlg.dlg)
+		if not confirm_dlg.ask():
+			logging.info("Sync canceled after the estimate")
+			progress_dlg.close()
+			return
+		progress_dlg.update('start sync', 0.0)
+		sync_progress = progress.Progress(sync.sync_num, sync.sync_bytes)
+		sync_progress.add_listener(update_listener)
+		sync_progress.add_listener(progress.log_listener)
 
-			except socket.timeout as e:
-				error_dlg = ErrorDlg('2sync - Error', 'Connection timeout', progress_dlg.dlg)
-				error_dlg.set_btn_close_event(error_dlg.close)
-				error_dlg.run()
+		try:
+			runner.run(self.cfg, self.pdata, self.roots, sync, sync_progress, on_error)
+		except Exception as e:
+			# Connection lost and reconnect failed
+			on_error(e)
 
-			except Exception as e:
-				error_dlg = ErrorDlg('2sync - Error', str(e), progress_dlg.dlg)
-				error_dlg.set_btn_close_event(error_dlg.close)
-				error_dlg.run()
+		sync_progress.close()
 
-		for sync in synclist:
-			if sync[0] in synced:
-				self.pdata.add(sync[0], sync[1][sync[0]])
-				sync[2].add(sync[0], sync[1][sync[0]])
+		if len(sync.errors) > 0:
+			error_dlg = ErrorDlg('2sync - Error', '\n'.join('%s: %s' % error for error in sync.errors), progress_dlg.dlg)
+			error_dlg.set_btn_close_event(error_dlg.close)
+			error_dlg.run()
 
-		GLib.idle_add(self.treestore.clear)
-		changes, conflicts = utils.find_changes(self.pdata, self.roots[0], self.roots[1])
-		self.do_update_liststore(changes)
+		# Only the synced and failed paths (and their parents) are compared again
+		self.do_update_rows(utils.changes_of(self.pdata, self.roots[0], self.roots[1], utils.with_parents(synclist)))
 		
 		# Check if still shown
 		if progress_dlg.dlg.get_visible():
 			progress_dlg.close()
 
+	def do_sync_client(self, synclist, progress_dlg, on_error):
+		def update_listener(state):
+			if progress_dlg.dlg.get_visible():
+				progress_dlg.update(progress.format_state(state), progress.fraction(state))
+
+		items = [(sub_path, self.roots.index(src_data)) for sub_path, src_data, _ in synclist]
+		try:
+			result = self.client.sync(items, update_listener, [self.pdata] + self.roots)
+			if result['avoided_bytes'] > 0:
+				progress_dlg.set_first_text('2sync - sync data (%s not copied, only mtime changed)' % progress.format_size(result['avoided_bytes']))
+			if len(result['errors']) > 0:
+				error_dlg = ErrorDlg('2sync - Error', '\n'.join(result['errors']), progress_dlg.dlg)
+				error_dlg.set_btn_close_event(error_dlg.close)
+				error_dlg.run()
+
+			# The daemon compares only the synced paths and their parents again
+			self.do_update_rows(dict(result['changes']))
+		except Exception as e:
+			on_error(e)
+
+		if progress_dlg.dlg.get_visible():
+			progress_dlg.close()
+
 	###############################
 	## signal events
 	###############################
@@ -217,6 +369,8 @@ class MainWin(object):
 				root.close()
 			except:
 				pass
+		if self.client != None:
+			self.client.close()
 		Gtk.main_quit()
 
 	def on_win_sync_treeview_row_activated(self, widget, path, column):
@@ -386,8 +540,24 @@ class MissingHostKeyDlg(DlgTemplate):
 		if response == Gtk.ResponseType.NO:
 			self._answer = False
 
+class ConfirmDlg(DlgTemplate):
+	def __init__(self, first_text, secondary_text, transient_for=None):
+		super().__init__(first_text, secondary_text, "glade/confirm_dlg.glade", transient_for)
+		self._answer = False
+
+	def ask(self):
+		super().run()
+		GLib.idle_add(self.dlg.close)
+		return self._answer
+
+	###############################
+	## signal events
+	###############################
+	def on_dlg_response(self, widget, response):
+		self._answer = response == Gtk.ResponseType.YES
+
 class TwoSyncGUI(object):
-	def __init__(self, config_name):
+	def __init__(self, config_name, paths=None):
 		self.roots = []
 
 		progress_dlg = ProgressDlg('2sync - Read data', 'startup')
@@ -396,8 +566,26 @@ class TwoSyncGUI(object):
 		transient_for = progress_dlg.dlg
 
 		try:
+			# A running daemon has everything in memory already
+			try:
+				client = daemon.Client(config_name)
+			except (ConnectionRefusedError, FileNotFoundError):
+				client = None
+
+			if client != None:
+				progress_dlg.update('get changes from daemon', 0.5)
+				pdata, self.roots, changes, scanned = client.changes()
+
+				main_win = MainWin(None, pdata, self.roots, client)
+				main_win.do_update_liststore(sub_path for sub_path, _ in changes)
+				main_win.show_all()
+				progress_dlg.close()
+				# The files could have changed since the daemon has read them
+				main_win.do_refresh(scanned)
+				return
+
 			progress_dlg.update('load config', 0.01)
-			cfg = config.Config(config_name) # Expected exceptions: PermissionError, FileNotFoundError
+			cfg = config.Config(config_name, paths) # Expected exceptions: PermissionError, FileNotFoundError
 			
 			progress_dlg.update('load saved data', 0.02)
 			self.pdata = data.PersistenceData(cfg) # Expected exceptions: FileNotFoundError, PermissionError, EOFError (File corrupt)
@@ -417,9 +605,10 @@ class TwoSyncGUI(object):
 				self.roots.append(data.FSData(cfg.roots[1], cfg, progress_dlg.update)) # Expected exceptions: PermissionError
 
 			progress_dlg.update('analyse data', 0.95)
-			changes, conflicts = utils.find_changes(self.pdata, self.roots[0], self.roots[1])
+			utils.negotiate_hash(cfg.hash_algorithms, self.roots)
+			changes, conflicts = utils.find_changes(self.pdata, self.roots[0], self.roots[1], cfg.paths)
 
-			main_win = MainWin(self.pdata, self.roots)
+			main_win = MainWin(cfg, self.pdata, self.roots)
 			main_win.do_update_liststore(changes)
 			main_win.show_all()
 
@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+"""
+Checks time and memory of 2sync with big synthetic trees
+
+Builds the saved data and both roots in memory with the given number of entries and measures
+config filtering, the digests, find_changes, the plan of the sync, recording synced items and
+saving/loading the saved data.
+The time budgets are ratios to a reference merge, which compares the same entries with one dict
+lookup each and is measured with every size, so they don't depend on the speed of the machine.
+Fails (exit state 1) if a step takes more time than its ratio of the reference merge, more memory
+per million entries than the budget, or if it grows clearly faster than the number of entries (superlinear).
+tracemalloc makes every step a few times slower, so the time budget is only checked with --no-memory.
+"""
+import argparse
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Config and saved data are read from ~/.twosync, which is a temporary directory here
+home = tempfile.mkdtemp(prefix='2sync_scale_')
+os.environ['HOME'] = home
+os.mkdir(os.path.join(home, '.twosync'))
+
+from twosync import config, data, utils
+
+parser = argparse.ArgumentParser(description='time and memory check of 2sync with big trees')
+parser.add_argument('--sizes', default='100000,1000000,5000000', help='comma separated numbers of entries (default: 100000,1000000,5000000)')
+parser.add_argument('--time-budget', type=float, default=1.0, help='factor for the time budgets of all steps, which are ratios to the reference merge (default: 1)')
+parser.add_argument('--memory-budget', type=float, default=1024.0, help='maximal peak MiB per million entries for every step (default: 1024)')
+parser.add_argument('--growth', type=float, default=2.0, help='maximal growth of time and memory per entry from one size to the next, above the noise (default: 2)')
+parser.add_argument('--changed', type=float, default=0.01, help='part of the entries, which are changed on each root (default: 0.01)')
+parser.add_argument('--no-memory', action='store_true', help='measure only the time (tracemalloc makes everything a few times slower)')
+args = parser.parse_args()
+
+# Steps, which take less time (seconds) or memory (bytes) are too noisy to check the growth
+MIN_TIME = 0.5
+MIN_MEMORY = 16 * 1024 * 1024
+
+# Maximal time of every step as multiple of the reference merge with the same entries
+# (recording includes saving the data once)
+TIME_RATIOS = {
+	'build': 6.0,
+	'filter': 40.0,
+	'digests': 6.0,
+	'save': 6.0,
+	'load': 6.0,
+	'find_changes': 3.0,
+	'plan': 2.0,
+	'record': 6.0,
+}
+
+FILES_PER_DIR = 100
+DIRS_PER_DIR = 10
+
+def write_config():
+	with open(os.path.join(home, '.twosync', 'scale'), 'w') as f:
+		f.write('root = /tmp/scale_1\nroot = /tmp/scale_2\n')
+		f.write('ignore file = *.tmp\nignore file = .*\nignore not file = .keep\n')
+		f.write('ignore path = */node_modules\nignore path = */.git\n')
+
+def build(size):
+	"""
+	Returns a dictionary with size synthetic entries in a tree of directories
+	"""
+	entries = dict()
+	dirs = ['/']
+	pos = 0
+	while len(entries) < size:
+		parent = dirs[pos // DIRS_PER_DIR]
+		sub_dir = '%sdir_%d/' % (parent, pos)
+		entries[sub_dir] = data.DataFolderType('755')
+		dirs.append(sub_dir)
+		for number in range(min(FILES_PER_DIR, size - len(entries))):
+			entries['%sfile_%d.txt' % (sub_dir, number)] = data.DataFileType('644', 1500000000 + number, number * 100)
+		pos += 1
+	return entries
+
+def change(entries, part):
+	"""
+	Returns two copies of entries, where other files (part of all) are changed or removed
+
+	The changes don't conflict, a conflict would need the hash of a real file.
+	"""
+	rand = random.Random(0)
+	files = [sub_path for sub_path in entries if not sub_path.endswith('/')]
+	changed = rand.sample(files, 2 * int(len(files) * part))
+	roots = []
+	for sub_paths in [changed[0::2], changed[1::2]]:
+		root = dict(entries)
+		for sub_path in sub_paths:
+			if rand.random() < 0.2:
+				del root[sub_path]
+			else:
+				entry = root[sub_path]
+				root[sub_path] = data.DataFileType(entry.mode, entry.mtime + 1, entry.size + 1)
+		roots.append(root)
+	return roots
+
+def basic_data(entries):
+	_data = data.BasicData()
+	_data._data = entries
+	return _data
+
+class RemoteData(data.SSHData):
+	"""
+	Remote root with the entries in memory and without connection, so that small files are bundled in the plan
+	"""
+	def __init__(self, entries):
+		data.BasicData.__init__(self)
+		self._data = entries
+
+def merge(saved, root_1, root_2):
+	"""
+	Returns a set with the changed sub_paths of both roots, with one dict lookup per entry (the reference of the time budgets)
+	"""
+	changes = set()
+	for sub_path, entry in saved.items():
+		if root_1.get(sub_path) != entry or root_2.get(sub_path) != entry:
+			changes.add(sub_path)
+	for root in [root_1, root_2]:
+		for sub_path in root:
+			if sub_path not in saved:
+				changes.add(sub_path)
+	return changes
+
+def measure(function):
+	"""
+	Returns a tuple with the result of function, its time in seconds and its peak of memory in bytes
+	"""
+	gc.collect()
+	if args.no_memory:
+		start = time.perf_counter()
+		return function(), time.perf_counter() - start, 0
+
+	tracemalloc.reset_peak()
+	start_memory = tracemalloc.get_traced_memory()[0]
+	start = time.perf_counter()
+	result = function()
+	seconds = time.perf_counter() - start
+	return result, seconds, tracemalloc.get_traced_memory()[1] - start_memory
+
+def run(size):
+	"""
+	Returns a dictionary with the step as key and a tuple of seconds and peak bytes as value
+	"""
+	results = dict()
+	cfg = config.Config('scale')
+
+	saved, *results['build'] = measure(lambda: build(size))
+	root_1, root_2 = change(saved, args.changed)
+	_, *results['merge'] = measure(lambda: merge(saved, root_1, root_2))
+
+	def filtering():
+		for sub_path in root_1:
+			if sub_path.endswith('/'):
+				cfg.test_dir(sub_path)
+			else:
+				cfg.test_file(sub_path)
+	_, *results['filter'] = measure(filtering)
+
+	pdata = data.PersistenceData(cfg)
+	pdata._data = dict(saved)
+	pdata._digests = None
+	_, *results['digests'] = measure(pdata.keep_digests)
+	_, *results['save'] = measure(pdata._save_data)
+	# Without changed config, the saved data isn't filtered again
+	cfg = config.Config('scale')
+	pdata, *results['load'] = measure(lambda: data.PersistenceData(cfg))
+
+	datas = [pdata, basic_data(root_1), basic_data(root_2)]
+	(changes, conflicts), *results['find_changes'] = measure(lambda: utils.find_changes(*datas))
+
+	def planning():
+		first, second = basic_data(root_1), RemoteData(root_2)
+		synclist = []
+		for sub_path in sorted(changes - conflicts):
+			if root_1.get(sub_path) != saved.get(sub_path):
+				synclist.append((sub_path, first, second))
+			else:
+				synclist.append((sub_path, second, first))
+		return data.SyncData(synclist, cfg.bundle_size, verify_mtime=False)
+	_, *results['plan'] = measure(planning)
+
+	def recording():
+		with pdata.deferred_save():
+			for sub_path in changes:
+				if sub_path in root_1:
+					pdata.add(sub_path, root_1[sub_path])
+				elif sub_path in pdata.data:
+					pdata.remove(sub_path)
+	_, *results['record'] = measure(recording)
+
+	os.remove(cfg._path_data)
+	return results
+
+def check(all_results):
+	"""
+	Returns a list with the exceeded budgets and superlinear steps
+	"""
+	failures = []
+	sizes = sorted(all_results)
+	for size in sizes:
+		merge_seconds = all_results[size]['merge'][0]
+		for step, (seconds, memory) in all_results[size].items():
+			millions = size / 1000000
+			budget = TIME_RATIOS.get(step, 1.0) * args.time_budget * merge_seconds
+			if args.no_memory and seconds > MIN_TIME and seconds > budget:
+				failures.append('%s with %d entries: %.2f s exceed the time budget of %.2f s (%.1f times the merge)' % (step, size, seconds, budget, seconds / merge_seconds))
+			if memory > args.memory_budget * 1024 * 1024 * max(millions, 0.1):
+				failures.append('%s with %d entries: %.0f MiB exceed the memory budget' % (step, size, memory / 1024 / 1024))
+
+	for smaller, bigger in zip(sizes, sizes[1:]):
+		# Bigger dictionaries fit worse in the caches, every step may grow as much as the reference merge
+		factor = max(bigger / smaller, all_results[bigger]['merge'][0] / all_results[smaller]['merge'][0])
+		for step, (seconds, memory) in all_results[bigger].items():
+			small_seconds, small_memory = all_results[smaller][step]
+			if seconds > MIN_TIME and seconds > small_seconds * factor * args.growth:
+				failures.append('%s: time grows superlinear from %d to %d entries (%.2f s to %.2f s)' % (step, smaller, bigger, small_seconds, seconds))
+			if memory > MIN_MEMORY and memory > small_memory * factor * args.growth:
+				failures.append('%s: memory grows superlinear from %d to %d entries (%.0f MiB to %.0f MiB)' % (step, smaller, bigger, small_memory / 1024 / 1024, memory / 1024 / 1024))
+	return failures
+
+write_config()
+if not args.no_memory:
+	tracemalloc.start()
+all_results = dict()
+for size in [int(size) for size in args.sizes.split(',')]:
+	print('%d entries' % size, flush=True)
+	all_results[size] = run(size)
+	for step, (seconds, memory) in all_results[size].items():
+		print('  %-28s %8.2f s %9.1f MiB' % (step, seconds, memory / 1024 / 1024), flush=True)
+
+shutil.rmtree(home)
+
+failures = check(all_results)
+for failure in failures:
+	print('FAIL: ' + failure)
+if len(failures) == 0:
+	print('OK')
+sys.exit(1 if len(failures) > 0 else 0)
@@ -1 +1 @@
-__all__ = ['config', 'data', 'utils', 'ssh']
\ No newline at end of file
+__all__ = ['config', 'data', 'utils', 'ssh', 'progress', 'runner', 'daemon', 'estimate']
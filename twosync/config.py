@@ -1,10 +1,54 @@
 import logging
 import os.path
-from twosync.utils import get_hash, get_str_hash, log_and_raise
+from twosync.utils import get_hash, get_str_hash, log_and_raise, HASH_ALGORITHMS, HASH_OPTIONAL
 from collections import namedtuple
 
 _filter = namedtuple('_filter', 'full, preglob, postglob, values')
 
+_units = {'': 1, 'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+def _parse_limit(value):
+	"""
+	Returns a tuple (start, end, rate) of a limit like "500K" or "2M 08:00-18:00", None if it's invalid
+
+	rate is in bytes per second, start and end are minutes of the day (None without time range).
+	"""
+	parts = value.split()
+	if len(parts) not in [1, 2] or len(parts[0]) == 0:
+		return None
+	number, unit = parts[0], ''
+	if number[-1].upper() in _units:
+		number, unit = number[:-1], number[-1].upper()
+	if not number.isdigit():
+		return None
+	rate = int(number) * _units[unit]
+	if len(parts) == 1:
+		return None, None, rate
+
+	minutes = []
+	for clock in parts[1].split('-'):
+		hour, _, minute = clock.partition(':')
+		if not hour.isdigit() or not minute.isdigit() or int(hour) > 24 or int(minute) > 59:
+			return None
+		minutes.append(int(hour) * 60 + int(minute))
+	if len(minutes) != 2:
+		return None
+	return minutes[0], minutes[1], rate
+
+def _parse_path(value):
+	"""
+	Returns the path entry value as directory with a final / (like '/dir/'), None if it's invalid
+	"""
+	if not value.startswith('/') or '..' in value.split('/'):
+		return None
+	return value.rstrip('/') + '/'
+
+def socket_path(configname):
+	"""
+	Returns the path of the unix socket of the daemon for configname
+	"""
+	return os.path.expanduser("~/.twosync/.socket_" + configname)
+
 class Config(object):
 	"""
 	The config object open a config file an prepare it for usage
@@ -16,26 +60,51 @@ class Config(object):
 		ignore path: which directories has to be ignored for synchronisation
 		ignore not file: files who sould synchronised, but match ignore file
 		ignore not path: directory who sould synchronised, but match ignore path
+		scan: "full" (default) lists every directory, "incremental" reads only the changed entries of a remote root (GNU find on the server)
+		hash cache: "none" (default) or "remote" to save the hashes of remote files in a file under the remote root
+		bundle size: files up to this size (in bytes) are transfered together in one tar stream (0 = disabled)
+		hash: algorithm to compare the content of files (default sha1). If set more than once, the first one supported by both roots is used
+		backup: days to keep replaced and removed files in .ts_backup under the root (0 = disabled, default)
+		backup runs: maximal number of backups to keep per root (0 = no limit, default)
+		verify: "none" (default) or "hash" to compare the hash of every copied file with its source before it's renamed into place
+		upload limit: bytes per second (with K, M or G) for copies to a remote root (0 = not limited, default). Can be
+			followed by a time range like "2M 08:00-18:00" and set more than once, the first matching time range is used
+		download limit: like upload limit for copies from a remote root
+		local limit: like upload limit for copies between local roots
+		priority: "small" or "recent" to copy smaller or more recently modified files first (default: in order of the paths).
+			If set more than once, the first one is the most important
+		path: directory relative to the root (like /projects/2sync), only the paths are read and synced (default: the whole root).
+			Can be set more than once
 	root has to be a absolutley path to a directory
 	All ignore-keys can use * at the value as placeholder for everything
 	"""
 
-	def __init__(self, configname):
+	def __init__(self, configname, paths=None):
+		"""
+		paths is an optional list of directories relative to the root, which replaces the path keys of the config file
+		"""
 		logging.info("Create config object")
 		
-		self._keys 			= ['root']
+		self._keys 			= ['root', 'scan', 'hash cache', 'bundle size', 'hash', 'backup', 'backup runs', 'verify', 'upload limit', 'download limit', 'local limit', 'priority', 'path']
 		self._parse_keys 	= ['ignore not file', 'ignore file', 'ignore not path', 'ignore path']
 		self._config 		= dict()
 		self._configname 	= configname
 		self._path_config 	= os.path.expanduser("~/.twosync/" + self._configname)
 		self._path_hash 	= os.path.expanduser("~/.twosync/.hash_" + self._configname)
 		self._path_data 	= os.path.expanduser("~/.twosync/.data_" + self._configname)
+		self._path_listing 	= os.path.expanduser("~/.twosync/.listing_" + self._configname)
+		self._path_plan 	= os.path.expanduser("~/.twosync/.plan_" + self._configname)
+		self._path_socket 	= socket_path(self._configname)
 
 		for key in (self._keys + self._parse_keys):
 			self._config[key] = []
 		
 		self._config_changed()
 		self._parse()
+
+		if paths != None:
+			self._config['path'] = list(paths)
+		self._check_paths()
 		
 	def _config_changed(self):
 		"""
@@ -119,22 +188,74 @@ class Config(object):
 		if self._config['root'][0].startswith('ssh://') and self._config['root'][1].startswith('ssh://'):
 			log_and_raise("Only one root can be an ssh path", e)
 
+		# Check scan mode
+		for value in self._config['scan']:
+			if value not in ['full', 'incremental']:
+				log_and_raise("Invalid scan mode: '" + value + "' in config-file: '" + self._path_config + "'")
+
+		# Check hash cache
+		for value in self._config['hash cache']:
+			if value not in ['none', 'remote']:
+				log_and_raise("Invalid hash cache: '" + value + "' in config-file: '" + self._path_config + "'")
+
+		# Check bundle size
+		for value in self._config['bundle size']:
+			if not value.isdigit():
+				log_and_raise("Invalid bundle size: '" + value + "' in config-file: '" + self._path_config + "'")
+
+		# Check hash algorithms
+		for value in self._config['hash']:
+			if value not in HASH_ALGORITHMS and value not in HASH_OPTIONAL:
+				log_and_raise("Invalid hash: '" + value + "' in config-file: '" + self._path_config + "'")
+
+		# Check backup
+		for key in ['backup', 'backup runs']:
+			for value in self._config[key]:
+				if not value.isdigit():
+					log_and_raise("Invalid " + key + ": '" + value + "' in config-file: '" + self._path_config + "'")
+
+		# Check verify
+		for value in self._config['verify']:
+			if value not in ['none', 'hash']:
+				log_and_raise("Invalid verify: '" + value + "' in config-file: '" + self._path_config + "'")
+
+		# Check limits
+		for key in ['upload limit', 'download limit', 'local limit']:
+			for value in self._config[key]:
+				if _parse_limit(value) == None:
+					log_and_raise("Invalid " + key + ": '" + value + "' in config-file: '" + self._path_config + "'")
+
+		# Check priority
+		for value in self._config['priority']:
+			if value not in ['small', 'recent']:
+				log_and_raise("Invalid priority: '" + value + "' in config-file: '" + self._path_config + "'")
+
 		# root path need a final /
 		if self._config['root'][0].endswith('/'):
 			self._config['root'][0] = self._config['root'][0][:-1]
 		if self._config['root'][1].endswith('/'):
 			self._config['root'][1] = self._config['root'][1][:-1]
 
+	def _check_paths(self):
+		"""
+		Test if the path keys are directories relative to the root and add the final /
+		"""
+		for pos, value in enumerate(self._config['path']):
+			path = _parse_path(value)
+			if path == None:
+				log_and_raise("Invalid path: '" + value + "' (has to start with /, without ..) for config-file: '" + self._path_config + "'")
+			self._config['path'][pos] = path
+
 	def _test(self, parsed_filters, sub_path):
 		for filters in parsed_filters:
-			logging.info("Test '" + sub_path + "' with filter: '" + filters.full + "'")
+			logging.debug("Test '%s' with filter: '%s'", sub_path, filters.full)
 			stat = 1
 			str_pos = 0
 			sum_filters = len(filters.values)
 			for pos in range(sum_filters):
 				# zero *, sub_path = filter
 				if sum_filters == 1 and filters.preglob == 0 and filters.postglob == 0 and sub_path == filters.values[0]:
-					logging.debug("'" + sub_path + "' matched filter: '" + str(filters.full) + "'")
+					logging.debug("'%s' matched filter: '%s'", sub_path, filters.full)
 					return True
 				# no pre *, first pos, filter != sub_path
 				if filters.preglob == 0 and pos == 0 and filters.values[pos] != sub_path[:len(filters.values[pos])]:
@@ -146,7 +267,7 @@ class Config(object):
 					break
 				# one filter, no pre or post *
 				if sum_filters == 1 and (filters.preglob == 0 or filters.postglob == 0):
-					logging.debug("'" + sub_path + "' matched filter: '" + str(filters.full) + "'")
+					logging.debug("'%s' matched filter: '%s'", sub_path, filters.full)
 					return True
 				str_pos2 = sub_path[str_pos:].find(filters.values[pos])
 				if str_pos2 == -1:
@@ -154,9 +275,9 @@ class Config(object):
 					break
 				str_pos += len(filters.values[pos])
 			if stat == 1:
-				logging.debug("'" + sub_path + "' matched filter: '" + str(filters.full) + "'")
+				logging.debug("'%s' matched filter: '%s'", sub_path, filters.full)
 				return True
-			logging.debug("'" + sub_path + "' doesn't matched filter: '" + str(filters.full) + "'")
+			logging.debug("'%s' doesn't matched filter: '%s'", sub_path, filters.full)
 		return False
 
 	def test_file(self, sub_path):
@@ -203,6 +324,98 @@ class Config(object):
 		"""
 		return self._config['root']
 	
+	@property
+	def incremental_scan(self):
+		"""
+		Returns True if only the changed entries of a remote root should be read (with the saved listing)
+		"""
+		return len(self._config['scan']) > 0 and self._config['scan'][-1] == 'incremental'
+
+	@property
+	def remote_hash_cache(self):
+		"""
+		Returns True if the hashes of remote files should be cached on the remote side
+		"""
+		return len(self._config['hash cache']) > 0 and self._config['hash cache'][-1] == 'remote'
+
+	@property
+	def bundle_size(self):
+		"""
+		Returns the size in bytes up to which files are transfered in bundles. 0 if disabled
+		"""
+		if len(self._config['bundle size']) == 0:
+			return 0
+		return int(self._config['bundle size'][-1])
+
+	@property
+	def hash_algorithms(self):
+		"""
+		Returns a list with the hash algorithms in order of preference
+		"""
+		if len(self._config['hash']) == 0:
+			return ['sha1']
+		return self._config['hash']
+
+	@property
+	def backup_days(self):
+		"""
+		Returns the number of days replaced and removed files are kept. 0 if disabled
+		"""
+		if len(self._config['backup']) == 0:
+			return 0
+		return int(self._config['backup'][-1])
+
+	@property
+	def backup_runs(self):
+		"""
+		Returns the maximal number of backups per root. 0 if not limited
+		"""
+		if len(self._config['backup runs']) == 0:
+			return 0
+		return int(self._config['backup runs'][-1])
+
+	@property
+	def verify(self):
+		"""
+		Returns True if copied files should be verified by their hash
+		"""
+		return len(self._config['verify']) > 0 and self._config['verify'][-1] == 'hash'
+
+	@property
+	def rate_limits(self):
+		"""
+		Returns a dictionary with 'upload', 'download' and 'local' as key and the schedule for a twosync.utils.RateLimiter as value
+
+		Limits with a time range come first, the last one without time range is the default.
+		"""
+		limits = dict()
+		for direction in ['upload', 'download', 'local']:
+			schedule = [_parse_limit(value) for value in self._config[direction + ' limit']]
+			limits[direction] = [limit for limit in schedule if limit[0] != None] + [limit for limit in reversed(schedule) if limit[0] == None]
+		return limits
+
+	@property
+	def priority(self):
+		"""
+		Returns a list with the order of copied files ('small', 'recent'), the most important first
+		"""
+		return self._config['priority']
+
+	@property
+	def paths(self):
+		"""
+		Returns a sorted list with the directories (with a final /), which are synced. An empty list for the whole root
+
+		Directories inside of other paths are left out.
+		"""
+		if '/' in self._config['path']:
+			return []
+		paths = []
+		for path in sorted(set(self._config['path'])):
+			if len(paths) == 0 or not path.startswith(paths[-1]):
+				paths.append(path)
+		return paths
+
 	@property
 	def config_changed(self):
 		"""
@@ -0,0 +1,320 @@
+from twosync import config, data, progress, runner, utils
+import json
+import logging
+import os
+import paramiko
+import socket
+import socketserver
+import threading
+import time
+
+class Snapshot(data.BasicData):
+	"""
+	Data of a root or the saved data as received from the daemon (only the changed paths)
+	"""
+	def __init__(self, path=''):
+		super().__init__()
+		self._path = path
+
+	def close(self):
+		pass
+
+	@property
+	def path(self):
+		return self._path
+
+class _Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			try:
+				request = json.loads(line.decode())
+				self.server.daemon.handle(request, self.send)
+			except Exception as e:
+				logging.exception("Request failed")
+				self.send({'error': str(e)})
+
+	def send(self, response):
+		self.wfile.write(json.dumps(response).encode() + b'\n')
+		self.wfile.flush()
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+class Daemon(object):
+	"""
+	Keeps the config, the saved data and both roots (with their ssh connections) in memory
+
+	Clients talk to the daemon over a unix socket under ~/.twosync with one json object per line.
+	Every request has a 'command':
+		status: paths of the roots and if a sync is running
+		changes: changed paths with the data of pdata and both roots, conflicts. The roots are only read
+			by rescan (and the synced paths by sync), 'scanned' is the time of the last scan
+		rescan: reads both roots again and returns the changes
+		sync: syncs 'items' (list of sub_path and index of the source root), sends the progress and the result.
+			The paths are read again before, items with a changed destination are skipped. The result has the
+			'changes' of the synced paths and their parents (like changes, with unchanged paths)
+		cancel: cancels the running sync
+		stop: stops the daemon
+	Errors are returned as {'error': message}.
+	"""
+	def __init__(self, configname, callback=None, policy=paramiko.client.RejectPolicy, paths=None):
+		self.config = config.Config(configname, paths)
+		self.pdata = data.PersistenceData(self.config)
+		# Start of the last scan of the roots, changes after it are unknown
+		self._scanned = time.time()
+		self.roots = runner.open_roots(self.config, callback, policy)
+		utils.negotiate_hash(self.config.hash_algorithms, self.roots)
+		# The data stays in memory, the digests let changes skip the paths, where nothing has changed
+		for _data in [self.pdata] + self.roots:
+			_data.keep_digests()
+
+		# Only one sync or scan at a time
+		self._lock = threading.Lock()
+		self._progress = None
+		self._server = None
+
+	def serve(self):
+		"""
+		Serves clients until stop is called
+		"""
+		path = self.config._path_socket
+		if os.path.exists(path):
+			try:
+				Client(self.config.configname).close()
+				utils.log_and_raise("Daemon for '" + self.config.configname + "' is already running")
+			except (ConnectionRefusedError, FileNotFoundError):
+				# Left by a daemon, which wasn't stopped
+				os.remove(path)
+
+		umask = os.umask(0o077)
+		try:
+			self._server = _Server(path, _Handler)
+		finally:
+			os.umask(umask)
+		self._server.daemon = self
+
+		logging.info("Daemon listens on '" + path + "'")
+		try:
+			self._server.serve_forever()
+		finally:
+			self._server.server_close()
+			os.remove(path)
+			for root in self.roots:
+				root.close()
+
+	def stop(self):
+		if self._progress != None:
+			self._progress.cancel()
+		threading.Thread(target=self._server.shutdown).start()
+
+	def handle(self, request, send):
+		command = request.get('command')
+		if command == 'status':
+			send({'roots': [root.path for root in self.roots], 'busy': self._lock.locked()})
+		elif command == 'changes':
+			with self._lock:
+				send(self.changes())
+		elif command == 'rescan':
+			with self._lock:
+				scanned = time.time()
+				for root in self.roots:
+					root.rescan(self.config)
+				self._scanned = scanned
+				send(self.changes())
+		elif command == 'sync':
+			with self._lock:
+				send(self.sync(request['items'], send))
+		elif command == 'cancel':
+			if self._progress != None:
+				self._progress.cancel()
+			send({})
+		elif command == 'stop':
+			send({})
+			self.stop()
+		else:
+			send({'error': "Unknown command: '" + str(command) + "'"})
+
+	def changes(self):
+		"""
+		Returns the changes between the roots as dictionary for json
+		"""
+		changes = []
+		for sub_path, change in utils.iter_changes(self.pdata, self.roots[0], self.roots[1], self.config.paths):
+			if change is not utils.ChangeType.NONE:
+				changes.append(self._encode(sub_path, change))
+		changes.sort()
+		return {'roots': [root.path for root in self.roots], 'changes': changes, 'scanned': self._scanned}
+
+	def _encode(self, sub_path, change):
+		"""
+		Returns sub_path with its ChangeType and its data of pdata and both roots as list for json
+		"""
+		return [sub_path, change.name] + [data.encode(_data[sub_path]) for _data in [self.pdata] + self.roots]
+
+	def _planned(self, items, errors):
+		"""
+		Returns the synclist of items, whose destination is still like the data, which the changes were based on
+
+		The paths of items are read again on both roots, the data in memory can be older than the files.
+		Items, which are synced already, are saved in pdata. Skipped items are added to errors.
+		"""
+		planned = [(sub_path, self.roots[src], self.roots[1 - src], self.roots[1 - src][sub_path]) for sub_path, src in items]
+		sub_paths = [sub_path for sub_path, _ in items]
+		for root in self.roots:
+			root.refresh(sub_paths)
+
+		synclist = []
+		with self.pdata.deferred_save():
+			for sub_path, src_data, dst_data, dst_planned in planned:
+				if src_data[sub_path] == dst_data[sub_path]:
+					runner.record([self.pdata], sub_path, src_data[sub_path])
+				elif dst_data[sub_path] != dst_planned:
+					logging.warning("Skip '" + sub_path + "': changed since the changes were read")
+					errors.append(sub_path + ': changed since the changes were read, rescan first')
+				else:
+					synclist.append((sub_path, src_data, dst_data))
+		return synclist
+
+	def sync(self, items, send):
+		"""
+		Syncs items (pairs of sub_path and index of the source root) and sends the progress with send
+		"""
+		errors = []
+		synclist = self._planned(items, errors)
+		sync = data.SyncData(synclist, self.config.bundle_size, backup=self.config.backup_days > 0, verify=self.config.verify,
+			priority=self.config.priority, limits=self.config.rate_limits)
+
+		def on_error(e):
+			errors.append(str(e))
+
+		def send_progress(state):
+			try:
+				send({'progress': list(state)})
+			except OSError:
+				# Client is gone, the sync goes on
+				pass
+
+		self._progress = progress.Progress(sync.sync_num, sync.sync_bytes)
+		self._progress.add_listener(send_progress)
+		self._progress.add_listener(progress.log_listener)
+		try:
+			synced = runner.run(self.config, self.pdata, self.roots, sync, self._progress, on_error)
+		except Exception as e:
+			# Connection lost and reconnect failed
+			synced = []
+			errors.append(str(e))
+		finally:
+			self._progress.close()
+			self._progress = None
+
+		# Only the synced and failed paths (and their parents) are compared again
+		changes = utils.changes_of(self.pdata, self.roots[0], self.roots[1], utils.with_parents(items))
+		return {'synced': synced, 'errors': errors + ['%s: %s' % error for error in sync.errors], 'avoided_bytes': sync.avoided_bytes,
+			'changes': sorted(self._encode(sub_path, change) for sub_path, change in changes.items())}
+
+def _apply(changes, snapshots):
+	"""
+	Adds the data of changes (from Daemon._encode) to snapshots (pdata and both roots), removes missing paths
+
+	Returns a list with the sub_path and ChangeType of every change.
+	"""
+	result = []
+	for sub_path, change, *values in changes:
+		for _data, value in zip(snapshots, values):
+			if value != None:
+				_data.add(sub_path, data.decode(value))
+			elif sub_path in _data.data:
+				_data.remove(sub_path)
+		result.append((sub_path, utils.ChangeType[change]))
+	return result
+
+class Client(object):
+	"""
+	Connection to the daemon of a config
+
+	Raises FileNotFoundError or ConnectionRefusedError if no daemon is running.
+	"""
+	def __init__(self, configname):
+		self._configname = configname
+		self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self._socket.connect(config.socket_path(configname))
+		except OSError:
+			self._socket.close()
+			raise
+		self._file = self._socket.makefile('rb')
+
+	def _request(self, command, **args):
+		"""
+		Sends a request and yields the responses (more than one for a sync)
+		"""
+		args['command'] = command
+		self._socket.sendall(json.dumps(args).encode() + b'\n')
+		while True:
+			line = self._file.readline()
+			if len(line) == 0:
+				raise ConnectionError("Connection to the daemon lost")
+			response = json.loads(line.decode())
+			if 'error' in response:
+				raise IOError(response['error'])
+			yield response
+			if 'progress' not in response:
+				break
+
+	def _call(self, command, **args):
+		for response in self._request(command, **args):
+			pass
+		return response
+
+	def status(self):
+		return self._call('status')
+
+	def copy(self):
+		"""
+		Returns a new connection to the same daemon (for a request beside a running one)
+		"""
+		return Client(self._configname)
+
+	def changes(self, rescan=False):
+		"""
+		Returns pdata and both roots as Snapshot with the changed paths, a list with the changes (sub_path, ChangeType)
+		and the time, when the daemon has read the roots
+
+		Changes after that time are missing. With rescan=True both roots are read again before.
+		"""
+		response = self._call('rescan' if rescan else 'changes')
+		pdata = Snapshot()
+		roots = [Snapshot(path) for path in response['roots']]
+		changes = _apply(response['changes'], [pdata] + roots)
+		return pdata, roots, changes, response['scanned']
+
+	def sync(self, items, listener=None, snapshots=None):
+		"""
+		Syncs items (pairs of sub_path and index of the source root)
+
+		listener is called with every ProgressState. Returns the result as dictionary with 'synced', 'errors' and
+		'changes' (list of sub_path and ChangeType of the synced paths and their parents). snapshots (pdata and
+		both roots from changes) are updated with the data of these paths.
+		"""
+		for response in self._request('sync', items=items):
+			if 'progress' in response and listener != None:
+				listener(progress.ProgressState(*response['progress']))
+		response['changes'] = _apply(response['changes'], snapshots if snapshots != None else [Snapshot() for _ in range(3)])
+		return response
+
+	def cancel(self):
+		"""
+		Cancels the running sync (over an own connection, this one could wait for the sync)
+		"""
+		client = self.copy()
+		try:
+			client._call('cancel')
+		finally:
+			client.close()
+
+	def stop(self):
+		self._call('stop')
+
+	def close(self):
+		self._file.close()
+		self._socket.close()
@@ -1,61 +1,487 @@
-from stat import S_ISDIR, S_ISREG
+from stat import S_IFDIR, S_IFREG, S_ISDIR, S_ISREG
 from collections import namedtuple
 from twosync import utils
 from enum import Enum
 import paramiko
+from paramiko.sftp import CMD_EXTENDED, CMD_MKDIR, CMD_REMOVE, CMD_RMDIR, CMD_SETSTAT, CMD_STATUS
+from bisect import bisect_left
+import concurrent.futures
+import contextlib
+import fcntl
 import hashlib
+import json
 import os
 import pickle
 import logging
+import shlex
 import shutil
+import socket
+import tarfile
 import threading
+import time
 
 DiffType = Enum('DiffType', 'NONE NEW REMOVED TYPE MODE MTIME CONTENT')
 Direction = Enum('Direction', 'LEFT RIGHT')
 
+_attr = namedtuple('_attr', 'mode, mtime, ctime, size')
+
+# Files in the root, which are used by 2sync itself and never synchronised
+_reserved = ['/.ts_hash_cache', '/.ts_backup']
+
+# ioctl to clone a file on filesystems with reflinks (btrfs, xfs)
+_FICLONE = 0x40049409
+
+def _tmp_path(sub_path):
+	"""
+	Returns the temporary path for a secure copy of sub_path
+	"""
+	sub_path_tmp = sub_path.rsplit("/", 1)
+	return '%s/.ts_%s_%s' % (sub_path_tmp[0], sub_path_tmp[1], utils.get_str_hash(sub_path))
+
 class SyncData(object):
-	def __init__(self, synclist):
+	_bundle_files = 1000
+	_bundle_bytes = 64 * 1024 * 1024
+	_batch_items = 1000
+
+	def __init__(self, synclist, bundle_size=0, verify_mtime=True, backup=False, verify=False, priority=(), limits=None):
+		self.items = list(synclist)
+		# Copied files are compared by hash with their source
+		self.verify = verify
+		# Order of the copied files ('small', 'recent'), the most important first
+		self._priority = priority
+		# One RateLimiter per direction ('upload', 'download', 'local'), shared by all transfers
+		self.limiters = dict()
+		if limits != None:
+			self.limiters = dict((direction, utils.RateLimiter(schedule)) for direction, schedule in limits.items() if len(schedule) > 0)
+
+		# Replaced and removed files are moved to a backup of this run
+		if backup:
+			stamp = time.strftime('%Y%m%d-%H%M%S')
+			for dst_data in set(sync[2] for sync in synclist):
+				dst_data.start_backup(stamp)
 		syncnew = [sync for sync in synclist if sync[2][sync[0]].diff(sync[1][sync[0]]) == DiffType.NEW]
 		syncrm = [sync for sync in synclist if sync[2][sync[0]].diff(sync[1][sync[0]]) == DiffType.REMOVED]
 		syncnew.sort(key=lambda path: path[0], reverse=True)
 		syncrm.sort(key=lambda path: path[0])
-		synclist = [sync for sync in synclist if sync not in syncnew and sync not in syncrm]
+		new_or_removed = set(syncnew + syncrm)
+		synclist = [sync for sync in synclist if sync not in new_or_removed]
+		if len(priority) > 0:
+			# New folders stay in the order of their paths (before their content). The last item is synced first
+			syncnew = sorted((sync for sync in syncnew if isinstance(sync[1][sync[0]], DataFileType)), key=self._priority_key, reverse=True) \
+				+ [sync for sync in syncnew if not isinstance(sync[1][sync[0]], DataFileType)]
+			synclist.sort(key=self._priority_key, reverse=True)
 
 		self.synclist = syncrm + synclist + syncnew
 		self.sync_num = len(self.synclist)
+		# Removed directories with all their content are removed at once
+		self.trees = self._removed_trees(syncrm)
+		in_trees = set(sync for items in self.trees.values() for sync in items)
+		self.synclist = [sync for sync in self.synclist if sync not in in_trees]
+		# The item(s) or bundle, which is synced at the moment (for retry)
+		self._current = None
+		# sub_paths of files with the same content on both sides, which only need the mtime
+		self.mtime_only = set()
+		self.avoided_bytes = 0
+		# Files, which would be hashed to find mtime_only, but weren't with verify_mtime=False: (src_data, dst_data) -> sub_paths
+		self.unverified = self._mtime_candidates()
+		if verify_mtime:
+			self._verify_mtime(self.unverified)
+			self.unverified = dict()
+		# bytes of all files, which has to be copied
+		self.sync_bytes = sum(sync[1][sync[0]].size for sync in self.synclist if self._copied(sync))
 		self.synced = 0
+		# (sub_path, message) of files, which failed inside a bundle
+		self.errors = []
+
+		# Small files between a local and a remote root are transfered in bundles, after all other items
+		self.bundles = []
+		if bundle_size > 0:
+			bundled = [sync for sync in self.synclist if self._bundled(sync, bundle_size)]
+			in_bundles = set(bundled)
+			self.synclist = [sync for sync in self.synclist if sync not in in_bundles]
+			for direction in set((sync[1], sync[2]) for sync in bundled):
+				bundle = []
+				bundle_bytes = 0
+				for sync in sorted((sync for sync in bundled if (sync[1], sync[2]) == direction), key=self._priority_key):
+					if len(bundle) >= self._bundle_files or bundle_bytes >= self._bundle_bytes:
+						self.bundles.append(bundle)
+						bundle = []
+						bundle_bytes = 0
+					bundle.append(sync)
+					bundle_bytes += sync[1][sync[0]].size
+				self.bundles.append(bundle)
+			# The last bundle is synced first
+			self.bundles.reverse()
+
+	def _priority_key(self, sync):
+		"""
+		Returns the sort key of sync for the priority, items without copied content come first
+
+		Files of the same magnitude (power of 2) are equally small. Without priority the key is the path.
+		"""
+		sub_path, src_data, _ = sync
+		data = src_data[sub_path]
+		if not isinstance(data, DataFileType):
+			return (0, sub_path)
+		key = [1]
+		for priority in self._priority:
+			if priority == 'small':
+				key.append(data.size.bit_length())
+			elif priority == 'recent':
+				key.append(-data.mtime)
+		return tuple(key + [sub_path])
+
+	def limiter(self, src_data, dst_data):
+		"""
+		Returns the RateLimiter of the direction from src_data to dst_data or None if it's not limited
+		"""
+		if isinstance(dst_data, SSHData):
+			return self.limiters.get('upload')
+		if isinstance(src_data, SSHData):
+			return self.limiters.get('download')
+		return self.limiters.get('local')
+
+	def _removed_trees(self, syncrm):
+		"""
+		Returns a dictionary with (sub_path, dst_data) of removed directories as key and the removed items inside as value
+
+		Only the topmost directories are returned, whose known content is completely removed.
+		"""
+		trees = dict()
+		for dst_data in set(sync[2] for sync in syncrm):
+			removed = sorted((sync for sync in syncrm if sync[2] is dst_data), key=lambda sync: sync[0])
+			removed_paths = [sync[0] for sync in removed]
+			known_paths = sorted(dst_data.data)
+			tree = None
+			for pos, sub_path in enumerate(removed_paths):
+				if tree != None and sub_path.startswith(tree):
+					continue
+				tree = None
+				if not sub_path.endswith('/'):
+					continue
+				# All paths inside sub_path are between '/dir/' and '/dir0'
+				end = sub_path[:-1] + '0'
+				count = bisect_left(removed_paths, end) - pos
+				if count > 1 and count == bisect_left(known_paths, end) - bisect_left(known_paths, sub_path):
+					trees[(sub_path, dst_data)] = removed[pos + 1:pos + count]
+					tree = sub_path
+		return trees
+
+	def _sync_tree(self, first, progress=None):
+		"""
+		Removes the directory first with its content at once
+
+		If the directory contains unknown files (like ignored files), the items are put back to be removed
+		one by one. Returns a list with the synced sub_paths
+		"""
+		sub_path, src_data, dst_data = first
+		items = self.trees.pop((sub_path, dst_data))
+		self._current = ('tree', (first, items))
+
+		if progress != None:
+			progress.start_item(sub_path)
+
+		if not dst_data.rmtree(sub_path, set(sync[0][len(sub_path):] for sync in items)):
+			logging.info("Remove '" + sub_path + "' item by item: it contains unknown files")
+			self.synclist.extend([first] + items)
+			return self._sync_next(progress)
+
+		self.synced += len(items) + 1
+		if progress != None:
+			progress.finish_item(len(items) + 1)
+		return [sub_path] + [sync[0] for sync in items]
+
+	def operations(self):
+		"""
+		Yields a tuple (operation, sub_path, src_data, dst_data, items, size) for every pending operation without doing it
+
+		operation is 'copy', 'mkdir', 'properties', 'remove', 'rmdir', 'tree' (a removed directory with its content)
+		or 'bundle' (sub_path is the first file). items is the number of synced items and size the number of copied bytes.
+		"""
+		for sync in reversed(self.synclist):
+			sub_path, src_data, dst_data = sync
+			if (sub_path, dst_data) in self.trees:
+				yield 'tree', sub_path, src_data, dst_data, len(self.trees[(sub_path, dst_data)]) + 1, 0
+				continue
+
+			diff = self._diff(sync)
+			# A changed type is removed and copied again, the item is counted once
+			if diff in [DiffType.TYPE, DiffType.REMOVED]:
+				items = 1 if diff == DiffType.REMOVED else 0
+				if isinstance(dst_data[sub_path], DataFileType):
+					yield 'remove', sub_path, src_data, dst_data, items, 0
+				else:
+					yield 'rmdir', sub_path, src_data, dst_data, items, 0
+			if diff in [DiffType.NEW, DiffType.TYPE, DiffType.CONTENT]:
+				if isinstance(src_data[sub_path], DataFileType):
+					yield 'copy', sub_path, src_data, dst_data, 1, src_data[sub_path].size
+				else:
+					yield 'mkdir', sub_path, src_data, dst_data, 1, 0
+			elif diff in [DiffType.MODE, DiffType.MTIME]:
+				yield 'properties', sub_path, src_data, dst_data, 1, 0
+
+		for bundle in reversed(self.bundles):
+			yield 'bundle', bundle[0][0], bundle[0][1], bundle[0][2], len(bundle), sum(sync[1][sync[0]].size for sync in bundle)
+
+	def _verified(self, sync, digest, other):
+		"""
+		Saves digest as hash of sync on both sides, if it's the same as the hash other of the other side
+
+		Raises IOError if the hashes are different.
+		"""
+		sub_path, src_data, dst_data = sync
+		if digest != other:
+			raise IOError("Verification of '" + sub_path + "' failed: the copy has another hash than the source")
+		# The destination gets the data of the source
+		for _data in [src_data, dst_data]:
+			_data.set_hash(sub_path, src_data[sub_path], digest)
+
+	def _diff(self, sync):
+		"""
+		Returns the DiffType of sync, files with the same content are DiffType.MTIME
+		"""
+		sub_path, src_data, dst_data = sync
+		if sub_path in self.mtime_only:
+			return DiffType.MTIME
+		return dst_data[sub_path].diff(src_data[sub_path])
+
+	def _mtime_candidates(self):
+		"""
+		Returns a dictionary with (src_data, dst_data) as key and a list with the sub_paths of the files with
+		the same size but another mtime as value
+		"""
+		candidates = dict()
+		for sync in self.synclist:
+			sub_path, src_data, dst_data = sync
+			if self._diff(sync) == DiffType.CONTENT and src_data[sub_path].size == dst_data[sub_path].size:
+				candidates.setdefault((src_data, dst_data), []).append(sub_path)
+		return candidates
+
+	def _verify_mtime(self, candidates):
+		"""
+		Compares the hashes of candidates (see _mtime_candidates), to find files with the same content
+		"""
+		for (src_data, dst_data), sub_paths in candidates.items():
+			logging.info("Compare hashes of " + str(len(sub_paths)) + " files with changed mtime")
+			src_hashes, dst_hashes = utils.hash_parallel([src_data, dst_data], sub_paths)
+			for sub_path in sub_paths:
+				if sub_path in src_hashes and src_hashes[sub_path] == dst_hashes.get(sub_path):
+					self.mtime_only.add(sub_path)
+					self.avoided_bytes += src_data[sub_path].size
+
+	def _copied(self, sync):
+		"""
+		Returns True if the content of the file sync has to be copied
+		"""
+		sub_path, src_data, dst_data = sync
+		if not isinstance(src_data[sub_path], DataFileType):
+			return False
+		return self._diff(sync) in [DiffType.NEW, DiffType.TYPE, DiffType.CONTENT]
+
+	def _bundled(self, sync, bundle_size):
+		"""
+		Returns True if sync is a small new or changed file between a local and a remote root
+		"""
+		sub_path, src_data, dst_data = sync
+		if isinstance(src_data, SSHData) == isinstance(dst_data, SSHData):
+			return False
+		if not isinstance(src_data[sub_path], DataFileType) or src_data[sub_path].size > bundle_size:
+			return False
+		return self._diff(sync) in [DiffType.NEW, DiffType.CONTENT]
+
+	def _sync_bundle(self, bundle, progress=None):
+		"""
+		Transfers a bundle and returns a list with the synced sub_paths
+		"""
+		src_data = bundle[0][1]
+		dst_data = bundle[0][2]
+
+		if progress != None:
+			progress.start_item('%s files from %s' % (len(bundle), src_data.path))
+
+		files = [(sub_path, _tmp_path(sub_path)) for sub_path, *_ in bundle]
+		digests = None
+		if self.verify:
+			digests = dict()
+		limiter = self.limiter(src_data, dst_data)
+		if isinstance(dst_data, SSHData):
+			synced, errors = dst_data.put_bundle(src_data.path, files, digests, limiter)
+		else:
+			synced, errors = src_data.get_bundle(dst_data.path, files, dst_data.keep, digests, limiter)
+
+		if digests != None:
+			for sub_path in synced:
+				self._verified((sub_path, src_data, dst_data), digests[sub_path], digests[sub_path])
+
+		self.synced += len(bundle)
+		self.errors += errors
+		if progress != None:
+			progress.add_bytes(sum(sync[1][sync[0]].size for sync in bundle))
+			progress.finish_item(len(bundle))
+		return synced
+
+	def _sync_meta(self, first, progress=None):
+		"""
+		Sets mode and mtime of first and all other items with only changed properties on the same remote root
+
+		All SETSTAT requests are send in one batch. Returns a list with the synced sub_paths
+		"""
+		dst_data = first[2]
+		items = [first]
+		for sync in reversed(self.synclist):
+			if len(items) >= self._batch_items:
+				break
+			if sync[2] is dst_data and self._diff(sync) in [DiffType.MODE, DiffType.MTIME]:
+				items.append(sync)
+		batched = set(items[1:])
+		self.synclist = [sync for sync in self.synclist if sync not in batched]
+		self._current = ('items', items)
+
+		if progress != None:
+			progress.start_item('properties of %s items on %s' % (len(items), dst_data.path))
+
+		batch = dst_data.batch()
+		for sub_path, src_data, _ in items:
+			mtime = None
+			if isinstance(src_data[sub_path], DataFileType):
+				mtime = src_data[sub_path].mtime
+			batch.setstat(dst_data.path + sub_path, int(src_data[sub_path].mode, 8), mtime)
+
+		synced = []
+		for (path, error), (sub_path, *_) in zip(batch.wait(), items):
+			if error == None:
+				synced.append(sub_path)
+			else:
+				self.errors.append((sub_path, str(error)))
+
+		self.synced += len(items)
+		if progress != None:
+			progress.finish_item(len(items))
+		return synced
+
+	def sync_next(self, progress=None):
+		"""
+		Syncs the next item (or bundle) and returns a list with the synced sub_paths
+
+		progress is an optional twosync.progress.Progress, which is updated with the synced items and bytes.
+		"""
+		synced = self._sync_next(progress)
+		self._current = None
+		return synced
+
+	def retry(self):
+		"""
+		Puts the item(s) or bundle back, which failed at the last sync_next. Returns a list with their sub_paths
+		"""
+		if self._current == None:
+			return []
+
+		kind, items = self._current
+		self._current = None
+		if kind == 'bundle':
+			self.bundles.append(items)
+		elif kind == 'tree':
+			first, items = items
+			self.trees[(first[0], first[2])] = items
+			self.synclist.append(first)
+			items = [first] + items
+		else:
+			self.synclist.extend(reversed(items))
+		return [sub_path for sub_path, *_ in items]
+
+	def _sync_next(self, progress=None):
+		def cp(sub_path, src_data, dst_data, progress):
+			def cp_file(sub_path, src_data, dst_data, progress):
+				callback = None
+				if progress != None:
+					callback = progress.transfer_callback()
 
-	def sync_next(self, callback=None):
-		def cp(sub_path, src_data, dst_data, callback):
-			def cp_file(sub_path, src_data, dst_data, callback):
 				# temporary file name for secure copy
-				sub_path_tmp = sub_path.rsplit("/", 1)
-				sub_path_tmp = '%s/.ts_%s_%s' % (sub_path_tmp[0], sub_path_tmp[1], utils.get_str_hash(sub_path))
+				sub_path_tmp = _tmp_path(sub_path)
+
+				# The hash of the source is computed, while it's copied
+				digest = None
+				if self.verify:
+					digest = utils.HASH_ALGORITHMS[dst_data.hash_algorithm][0]()
+				limiter = self.limiter(src_data, dst_data)
+
+				def verify(other, remove):
+					"""
+					Compares the hash of the copy with other() (the hash of the other side), the copy is removed with remove if it fails
+					"""
+					try:
+						self._verified((sub_path, src_data, dst_data), digest.hexdigest(), other())
+					except IOError:
+						try:
+							remove("%s%s" % (dst_data.path, sub_path_tmp))
+						except OSError:
+							pass
+						raise
 
 				if isinstance(src_data, SSHData):
-					src_data.sftp_get("%s%s" % (src_data.path, sub_path), "%s%s" % (dst_data.path, sub_path_tmp), callback)
+					src_data.sftp_get("%s%s" % (src_data.path, sub_path), "%s%s" % (dst_data.path, sub_path_tmp), callback, digest, limiter)
+					if digest != None:
+						verify(lambda: src_data.get_hashes([sub_path]).get(sub_path), os.remove)
+					dst_data.keep(sub_path)
 					shutil.move("%s%s" % (dst_data.path, sub_path_tmp), "%s%s" % (dst_data.path, sub_path))
 				elif isinstance(dst_data, SSHData):
-					dst_data.sftp_put("%s%s" % (src_data.path, sub_path), "%s%s" % (dst_data.path, sub_path_tmp), callback)
-					try:
-						dst_data.sftp_remove("%s%s" % (dst_data.path, sub_path))
-					except Exception as e:
-						pass
-					dst_data.sftp_rename("%s%s" % (dst_data.path, sub_path_tmp), "%s%s" % (dst_data.path, sub_path))
+					dst_data.sftp_put("%s%s" % (src_data.path, sub_path), "%s%s" % (dst_data.path, sub_path_tmp), callback, digest, limiter)
+					if digest != None:
+						verify(lambda: dst_data.hash_tmp(sub_path_tmp, src_data[sub_path]), dst_data.sftp_remove)
+					# mode, mtime, backup and rename in one round trip
+					backup_path = None
+					if isinstance(dst_data[sub_path], DataFileType):
+						backup_path = dst_data.backup_path(sub_path)
+					batch = dst_data.batch()
+					batch.setstat("%s%s" % (dst_data.path, sub_path_tmp), int(src_data[sub_path].mode, 8), src_data[sub_path].mtime)
+					if backup_path != None:
+						batch.rename("%s%s" % (dst_data.path, sub_path), backup_path)
+					batch.rename("%s%s" % (dst_data.path, sub_path_tmp), "%s%s" % (dst_data.path, sub_path))
+					results = batch.wait()
+					if results[0][1] != None:
+						raise results[0][1]
+					if results[-1][1] != None:
+						# Server without posix-rename
+						if backup_path != None:
+							dst_data.sftp_rename("%s%s" % (dst_data.path, sub_path), backup_path)
+						else:
+							try:
+								dst_data.sftp_remove("%s%s" % (dst_data.path, sub_path))
+							except Exception as e:
+								pass
+						dst_data.sftp_rename("%s%s" % (dst_data.path, sub_path_tmp), "%s%s" % (dst_data.path, sub_path))
+					return True
 				else:
-					shutil.copyfile("%s%s" % (src_data.path, sub_path), "%s%s" % (dst_data.path, sub_path_tmp))
+					with open("%s%s" % (src_data.path, sub_path), 'rb') as src, open("%s%s" % (dst_data.path, sub_path_tmp), 'wb') as dst:
+						utils.copy_sparse(src, dst, os.fstat(src.fileno()).st_size, digest=digest, limiter=limiter)
+					if digest != None:
+						verify(lambda: utils.get_hash("%s%s" % (dst_data.path, sub_path_tmp), dst_data.hash_algorithm), os.remove)
+					dst_data.keep(sub_path)
 					shutil.move("%s%s" % (dst_data.path, sub_path_tmp), "%s%s" % (dst_data.path, sub_path))
+					if progress != None:
+						progress.add_bytes(src_data[sub_path].size)
+
+				return False
 
 			def mkdir(sub_path, src_data, dst_data):
 				if isinstance(dst_data, SSHData):
-					dst_data.mkdir("%s%s" % (dst_data.path, sub_path), int(src_data[sub_path].mode, 8))
+					# mkdir and mode (without umask) in one round trip
+					batch = dst_data.batch()
+					batch.mkdir("%s%s" % (dst_data.path, sub_path), int(src_data[sub_path].mode, 8))
+					batch.setstat("%s%s" % (dst_data.path, sub_path), int(src_data[sub_path].mode, 8))
+					for _, error in batch.wait():
+						if error != None:
+							raise error
+					return True
 				else:
 					os.mkdir("%s%s" % (dst_data.path, sub_path), int(src_data[sub_path].mode, 8))
+					return False
 
+			# Returns True if mode and mtime are already set
 			if isinstance(src_data[sub_path], DataFileType):
-				cp_file(sub_path, src_data, dst_data, callback)
+				return cp_file(sub_path, src_data, dst_data, progress)
 			elif isinstance(src_data[sub_path], DataFolderType):
-				mkdir(sub_path, src_data, dst_data)
+				return mkdir(sub_path, src_data, dst_data)
 
 		def chmod(sub_path, data, mode):
 			mode = int(mode, 8)
@@ -78,47 +504,157 @@ class SyncData(object):
 					os.rmdir(dst_data.path + sub_path)
 
 			def remove(sub_path, dst_data):
+				backup_path = dst_data.backup_path(sub_path)
 				if isinstance(dst_data, SSHData):
-					dst_data.remove(dst_data.path + sub_path)
+					if backup_path != None:
+						dst_data.sftp_rename(dst_data.path + sub_path, backup_path)
+					else:
+						dst_data.sftp_remove(dst_data.path + sub_path)
 				else:
-					os.remove(dst_data.path + sub_path)
+					if backup_path != None:
+						os.rename(dst_data.path + sub_path, backup_path)
+					else:
+						os.remove(dst_data.path + sub_path)
 
 			if isinstance(dst_data[sub_path], DataFileType):
 				remove(sub_path, dst_data)
 			else:
 				rmdir(sub_path, dst_data)
 
+		if len(self.synclist) == 0:
+			bundle = self.bundles.pop()
+			self._current = ('bundle', bundle)
+			return self._sync_bundle(bundle, progress)
+
 		next = self.synclist.pop()
+		if (next[0], next[2]) in self.trees:
+			return self._sync_tree(next, progress)
+
+		self._current = ('items', [next])
 		sub_path = next[0]
 		src_data = next[1]
 		dst_data = next[2]
 
-		if callback != None:
-			callback(self.synced, self.sync_num, sub_path)
+		if progress != None:
+			progress.start_item(sub_path)
 
-		diff = dst_data[sub_path].diff(src_data[sub_path])
+		diff = self._diff(next)
+
+		if diff in [DiffType.MODE, DiffType.MTIME] and isinstance(dst_data, SSHData):
+			return self._sync_meta(next, progress)
 
 		if diff in [DiffType.TYPE, DiffType.REMOVED]:
 			rm(sub_path, dst_data)
 
+		attributes_set = False
 		if diff in [DiffType.NEW, DiffType.TYPE, DiffType.CONTENT]:
-			cp(sub_path, src_data, dst_data, callback)
+			attributes_set = cp(sub_path, src_data, dst_data, progress)
 
-		if diff in [DiffType.NEW, DiffType.TYPE, DiffType.CONTENT, DiffType.MODE]:
-			chmod(sub_path, dst_data, src_data[sub_path].mode)
+		if not attributes_set:
+			if diff in [DiffType.NEW, DiffType.TYPE, DiffType.CONTENT, DiffType.MODE] or (diff == DiffType.MTIME and dst_data[sub_path].mode != src_data[sub_path].mode):
+				chmod(sub_path, dst_data, src_data[sub_path].mode)
 
-		if diff in [DiffType.NEW, DiffType.TYPE, DiffType.CONTENT, DiffType.MODE, DiffType.MTIME] and isinstance(src_data[sub_path], DataFileType):
-			utime(sub_path, dst_data, src_data[sub_path].mtime)
+			if diff in [DiffType.NEW, DiffType.TYPE, DiffType.CONTENT, DiffType.MODE, DiffType.MTIME] and isinstance(src_data[sub_path], DataFileType):
+				utime(sub_path, dst_data, src_data[sub_path].mtime)
 
 		self.synced += 1
+		if progress != None:
+			progress.finish_item()
 
-		return sub_path
+		return [sub_path]
 
 	def finished(self):
-		if len(self.synclist) == 0:
+		if len(self.synclist) == 0 and len(self.bundles) == 0:
 			return True
 		return False
 
+def encode(data):
+	"""
+	Returns data (DataFileType, DataFolderType or DataNoneType) as list for json (None for DataNoneType)
+	"""
+	if isinstance(data, DataFileType):
+		return ['file'] + list(data)
+	if isinstance(data, DataFolderType):
+		return ['folder'] + list(data)
+	return None
+
+def decode(data):
+	"""
+	Returns the DataFileType, DataFolderType or DataNoneType of a list from encode
+	"""
+	if data == None:
+		return DataNoneType()
+	if data[0] == 'file':
+		return DataFileType(*data[1:])
+	return DataFolderType(*data[1:])
+
+class SyncPlan(object):
+	"""
+	Saved sync run, which can be resumed after an abort
+
+	The items are written once before the sync. Afterwards every synced sub_path is appended as checkpoint.
+	An item is saved with the index of the source root and the data of both sides at planning time.
+	"""
+	def __init__(self, config):
+		self._path_plan = config._path_plan
+		self._file = None
+
+	def create(self, items, roots):
+		"""
+		Saves items (tuples of sub_path, source and destination) as new plan
+		"""
+		with open(self._path_plan + '.tmp', 'w') as f:
+			for sub_path, src_data, dst_data in items:
+				f.write(json.dumps(['item', sub_path, roots.index(src_data), encode(src_data[sub_path]), encode(dst_data[sub_path])]) + '\n')
+		os.replace(self._path_plan + '.tmp', self._path_plan)
+		self._file = open(self._path_plan, 'a')
+
+	def checkpoint(self, sub_paths):
+		"""
+		Saves sub_paths as synced
+		"""
+		for sub_path in sub_paths:
+			self._file.write(json.dumps(['done', sub_path]) + '\n')
+		self._file.flush()
+
+	def load(self):
+		"""
+		Returns a list of tuples (sub_path, source index, source data, destination data, done) or None without plan
+		"""
+		items = []
+		done = set()
+		try:
+			with open(self._path_plan, 'r') as f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						# Incomplete last line
+						continue
+					if entry[0] == 'item':
+						items.append((entry[1], entry[2], decode(entry[3]), decode(entry[4])))
+					elif entry[0] == 'done':
+						done.add(entry[1])
+		except FileNotFoundError:
+			return None
+
+		return [item + (item[0] in done,) for item in items]
+
+	def close(self):
+		if self._file != None:
+			self._file.close()
+			self._file = None
+
+	def finish(self):
+		"""
+		Removes the plan, after the sync run is complete
+		"""
+		self.close()
+		try:
+			os.remove(self._path_plan)
+		except FileNotFoundError:
+			pass
+
 class DataTypeTemplate():
 	def diff(self, data):
 		"""
@@ -143,9 +679,7 @@ class DataTypeTemplate():
 			return DiffType.CONTENT
 
 		if self.mtime != data.mtime:
-			# TODO: Compare hash
-			# WHILE NOT TESTING HASH, WE RETURN, THAT THE CONTENT HAS CHANGED. JUST TO BE SECURE
-			# return DiffType.MTIME
+			# SyncData turns files with the same content (hash) into DiffType.MTIME
 			return DiffType.CONTENT
 
 		if self.mode != data.mode:
@@ -168,9 +702,58 @@ class DataNoneType(namedtuple('DataNoneType', ''), DataTypeTemplate):
 	Special type for data, just for diff functionality
 	"""
 
+def _parent(sub_path):
+	"""
+	Returns the directory of sub_path (with a final /) or None for the root
+	"""
+	if sub_path == '/':
+		return None
+	return sub_path[:sub_path.rstrip('/').rfind('/') + 1]
+
+# Digests of directories are sums modulo _digest_modulus
+_digest_modulus = 2 ** 128
+
+def _entry_digest(sub_path, data):
+	"""
+	Returns the digest of one entry (its path and attributes) as integer
+	"""
+	entry = '%s\0%s' % (sub_path, tuple(data))
+	return int.from_bytes(hashlib.blake2b(entry.encode(errors='surrogateescape'), digest_size=16).digest(), 'big')
+
+def _add_digest(digests, sub_path, digest):
+	"""
+	Adds digest to the digests of all parent directories of sub_path
+	"""
+	parent = _parent(sub_path)
+	while parent != None:
+		digests[parent] = (digests.get(parent, 0) + digest) % _digest_modulus
+		parent = _parent(parent)
+
+def _tree_digests(data):
+	"""
+	Returns a dictionary with the digest of every directory in data
+
+	The digest of a directory is the sum of the digests of all entries inside of it (in any depth).
+	It doesn't depend on the order of the entries and can be updated for a single changed entry.
+	"""
+	# The entries are summed up per directory first, the sums go to the parent directories afterwards
+	sums = dict()
+	for sub_path, value in data.items():
+		parent = _parent(sub_path)
+		if parent != None:
+			sums[parent] = sums.get(parent, 0) + _entry_digest(sub_path, value)
+
+	digests = dict()
+	for sub_dir, digest in sums.items():
+		digests[sub_dir] = (digests.get(sub_dir, 0) + digest) % _digest_modulus
+		_add_digest(digests, sub_dir, digest)
+	return digests
+
 class BasicData(object):
 	def __init__(self):
 		self._data = dict()
+		# Digests of the directories, only if they are kept (see keep_digests)
+		self._digests = None
 
 	def __getitem__(self, key):
 		try:
@@ -178,30 +761,79 @@ class BasicData(object):
 		except KeyError:
 			return DataNoneType()
 
+	def _update_digests(self, sub_path, data):
+		"""
+		Updates the digests of the parent directories of sub_path for its new data (None if it's removed)
+		"""
+		if self._digests == None:
+			return
+		old = self._data.get(sub_path)
+		if old == data:
+			return
+		digest = 0
+		if old != None:
+			digest -= _entry_digest(sub_path, old)
+		if data != None:
+			digest += _entry_digest(sub_path, data)
+		_add_digest(self._digests, sub_path, digest)
+
 	def add_file(self, sub_path, mode, mtime, size):
-		logging.info("Add file '" + sub_path + "' for sync")
-		self._data[sub_path] = DataFileType(mode, mtime, size)
+		logging.debug("Add file '%s' for sync", sub_path)
+		data = DataFileType(mode, mtime, size)
+		self._update_digests(sub_path, data)
+		self._data[sub_path] = data
 
 	def add_folder(self, sub_path, mode):
-		logging.info("Add folder '" + sub_path + "' for sync")
-		self._data[sub_path] = DataFolderType(mode)
+		logging.debug("Add folder '%s' for sync", sub_path)
+		data = DataFolderType(mode)
+		self._update_digests(sub_path, data)
+		self._data[sub_path] = data
 
 	def add(self, sub_path, data):
+		self._update_digests(sub_path, data)
 		self._data[sub_path] = data
 
 	def remove(self, path):
+		self._update_digests(path, None)
 		del self._data[path]
 
 	@property
 	def data(self):
 		return self._data
 
+	@contextlib.contextmanager
+	def deferred_save(self):
+		"""
+		Context for many changes, the data is saved once at the end (if it's saved at all)
+		"""
+		yield self
+
+	def keep_digests(self):
+		"""
+		Computes the digests of all directories and updates them with every change from now on
+		"""
+		if self._digests == None:
+			self._digests = _tree_digests(self._data)
+
+	@property
+	def digests(self):
+		"""
+		Returns a dictionary with the digest of every directory over its whole content or None if they aren't kept
+
+		Directories with the same digest have the same content.
+		"""
+		return self._digests
+
 class PersistenceData(BasicData):
-	def __init__(self, config):
+	def __init__(self, config, read_only=False):
 		logging.info("Init PersistenceData with config changed = " + str(config.config_changed))
 		super().__init__()
 
 		self._path_data = config._path_data
+		# Changes are only kept in memory (for a dry run)
+		self._read_only = read_only
+		# Saving is deferred inside of deferred_save
+		self._deferred = 0
 
 		self._load_data()
 
@@ -219,10 +851,12 @@ class PersistenceData(BasicData):
 				else:
 					print("Corrupt data: type is '" + str(type(self.data[path])) + "'")
 
-			for path in remove:
-				self.remove(path)
+			with self.deferred_save():
+				for path in remove:
+					self.remove(path)
 
-			config._save_config_hash()
+			if not read_only:
+				config._save_config_hash()
 
 	def _load_data(self):
 		"""
@@ -230,17 +864,36 @@ class PersistenceData(BasicData):
 		"""
 		try:
 			with open(self._path_data, 'rb') as f:
-				self._data = pickle.load(f)
+				saved = pickle.load(f)
 		except FileNotFoundError as e:
-			pass
+			return
+
+		# Older versions saved the digests of the directories with the data
+		if isinstance(saved, tuple):
+			saved = saved[0]
+		self._data = saved
 
 	def _save_data(self):
 		"""
 		Save the informations about synchronised files and folders
 		"""
+		if self._read_only or self._deferred > 0:
+			return
 		with open(self._path_data, 'wb') as f:
 			pickle.dump(self._data, f)
 
+	@contextlib.contextmanager
+	def deferred_save(self):
+		"""
+		Saves the data once at the end of the with block, instead of after every change
+		"""
+		self._deferred += 1
+		try:
+			yield self
+		finally:
+			self._deferred -= 1
+			self._save_data()
+
 	def add_file(self, file, mode, mtime, size):
 		super().add_file(file, mode, mtime, size)
 		self._save_data()
@@ -258,48 +911,557 @@ class PersistenceData(BasicData):
 		super().remove(path)
 		self._save_data()
 
-class FSData(BasicData):
-	def __init__(self, path, config, callback=None):
-		logging.info("Init FSData with path: '" + path + "'")
+class ListingCache(object):
+	"""
+	Saved listing of a remote root, used for incremental scans
+
+	Every directory is saved with its inode and its entries (name -> (mode, mtime, size, inode)) and every
+	scanned path with the clock of the server, when its scan started. The next scan of a path lists only the
+	entries changed (ctime) since then and all entries of the changed directories. Only the directories visited
+	by the last scan of a path are kept.
+	"""
+	def __init__(self, config, adr):
+		logging.info("Init ListingCache for: '" + adr + "'")
+		self._path_listing = "%s_%s" % (config._path_listing, utils.get_str_hash(adr))
+		# sub_dir -> (inode, entries)
+		self.dirs = dict()
+		# Scanned sub_dir -> clock of the server at the start of the scan
+		self._clocks = dict()
+
+		self._load_data()
+
+	def _load_data(self):
+		try:
+			with open(self._path_listing, 'rb') as f:
+				self._clocks, self.dirs = pickle.load(f)
+		except (FileNotFoundError, EOFError, pickle.UnpicklingError, ValueError):
+			# Listings of an older format are read again
+			self._clocks = dict()
+			self.dirs = dict()
+
+	def save(self):
+		with open(self._path_listing, 'wb') as f:
+			pickle.dump((self._clocks, self.dirs), f)
+
+	def clock(self, sub_dir):
+		"""
+		Returns the clock of the last scan, which included sub_dir or None if there is no listing of sub_dir
+		"""
+		if sub_dir not in self.dirs:
+			return None
+		clocks = [clock for path, clock in self._clocks.items() if sub_dir.startswith(path)]
+		if len(clocks) == 0:
+			return None
+		return max(clocks)
+
+	def scanned(self, sub_dir, clock, visited):
+		"""
+		Saves clock as the start of the scan of sub_dir and removes the listings below it, which aren't in visited
+		"""
+		for path in [path for path in self._clocks if path.startswith(sub_dir)]:
+			del self._clocks[path]
+		self._clocks[sub_dir] = clock
+		for path in [path for path in self.dirs if path.startswith(sub_dir) and path not in visited]:
+			del self.dirs[path]
+
+class RemoteHashCache(object):
+	"""
+	Hashes of remote files, saved in the file '.ts_hash_cache' under the remote root
+
+	The key of a hash is inode, size and mtime of the file.
+	If a file changes, the key changes too and the saved hash is no longer used.
+	"""
+	_max_entries = 100000
+
+	def __init__(self, sftp_client, path):
+		logging.info("Init RemoteHashCache for: '" + path + "'")
+		self._sftp_client = sftp_client
+		self._path_cache = path + _reserved[0]
+		self._hashes = dict()
+		self._changed = False
+
+		self._load_data()
+
+	def _load_data(self):
+		try:
+			with self._sftp_client.open(self._path_cache, 'r') as f:
+				self._hashes = json.loads(f.read().decode())
+		except IOError:
+			pass
+		except ValueError:
+			logging.warning("Corrupt hash cache: '" + self._path_cache + "'")
+
+	def save(self):
+		"""
+		Save the hashes, if there are new ones
+		"""
+		if not self._changed:
+			return
+
+		# Drop the oldest hashes
+		keys = list(self._hashes.keys())
+		for key in keys[:max(0, len(keys) - self._max_entries)]:
+			del self._hashes[key]
+
+		with self._sftp_client.open(self._path_cache + '.tmp', 'w') as f:
+			f.write(json.dumps(self._hashes))
+		self._sftp_client.posix_rename(self._path_cache + '.tmp', self._path_cache)
+		self._changed = False
+
+	def get(self, key):
+		return self._hashes.get(key)
+
+	def set(self, key, digest):
+		# Re-insert, so the hash counts as new
+		self._hashes.pop(key, None)
+		self._hashes[key] = digest
+		self._changed = True
+
+class RootData(BasicData):
+	"""
+	Base for the data of a root, which is read from a filesystem
+
+	Subclasses have to implement _stat and _listdir.
+	"""
+	hash_algorithm = 'sha1'
+
+	def __init__(self):
 		super().__init__()
-		self._path = path
+		# Hashes, which are known from verified copies: sub_path -> (algorithm, data, hash)
+		self._hashes = dict()
+
+	def set_hash(self, sub_path, data, digest):
+		"""
+		Saves digest as hash of sub_path, as long as sub_path has the attributes data
+		"""
+		self._hashes[sub_path] = (self.hash_algorithm, data, digest)
+
+	def known_hash(self, sub_path):
+		"""
+		Returns the saved hash of sub_path or None, if it's unknown or the file has changed
+		"""
+		if sub_path in self._hashes:
+			algorithm, data, digest = self._hashes[sub_path]
+			if algorithm == self.hash_algorithm and data == self[sub_path]:
+				return digest
+		return None
+
+	def supports_hash(self, algorithm):
+		"""
+		Returns True if the hash algorithm can be used for this root
+		"""
+		return algorithm in utils.HASH_ALGORITHMS
+
+	def _stat(self, path):
+		"""
+		Returns the _attr of path
+		"""
+		raise NotImplementedError
+
+	def _listdir(self, path):
+		"""
+		Returns a dictionary with the filename as key and the _attr as value for all entries of path
+		"""
+		raise NotImplementedError
+
+	def refresh(self, sub_paths):
+		"""
+		Reads the attributes of sub_paths again, without reading the directories
+		"""
+		for sub_path in sub_paths:
+			try:
+				entry = self._stat(self.path + sub_path)
+			except FileNotFoundError:
+				entry = None
+
+			if entry != None and S_ISDIR(entry.mode) and sub_path.endswith('/'):
+				self.add_folder(sub_path, oct(entry.mode)[-3:])
+			elif entry != None and S_ISREG(entry.mode) and not sub_path.endswith('/'):
+				self.add_file(sub_path, oct(entry.mode)[-3:], abs(int(entry.mtime)), entry.size)
+			elif sub_path in self.data:
+				self.remove(sub_path)
+
+	def rescan(self, config, callback=None):
+		"""
+		Reads the whole root (or the paths of config) again
+
+		Kept digests are updated while the root is read.
+		"""
+		self._clear()
 		self._find_files(config, callback)
 
-	def _find_files(self, config, callback):
+	def _clear(self):
+		"""
+		Removes all entries (before the root is read again)
+		"""
+		self._data = dict()
+		if self._digests != None:
+			self._digests = dict()
+
+	def close(self, save=True):
+		"""
+		Closes the root. With save=False nothing is written (like the remote hash cache)
+		"""
+		pass
+
+	def _exists(self, path):
+		try:
+			self._stat(path)
+			return True
+		except FileNotFoundError:
+			return False
+
+	def _makedirs(self, path):
+		raise NotImplementedError
+
+	def _rename(self, old_path, new_path):
+		raise NotImplementedError
+
+	def _rmtree(self, path):
+		raise NotImplementedError
+
+	def _tree(self, path):
+		raise NotImplementedError
+
+	def rmtree(self, sub_path, known):
+		"""
+		Removes the directory sub_path with its whole content at once (or moves it to the backup)
+
+		known is a set with the paths inside, relative to sub_path (directories with a final /).
+		Nothing is removed and False is returned, if the directory contains anything else or can't be read.
+		"""
+		try:
+			if not self._tree(self.path + sub_path) <= known:
+				return False
+		except OSError as e:
+			logging.warning("Can't read '" + self.path + sub_path + "': " + str(e))
+			return False
+
+		backup_path = self.backup_path(sub_path.rstrip('/'))
+		if backup_path != None:
+			self._rename(self.path + sub_path.rstrip('/'), backup_path)
+		else:
+			self._rmtree(self.path + sub_path.rstrip('/'))
+		return True
+
+	def start_backup(self, stamp):
+		"""
+		Replaced and removed files are moved to .ts_backup/stamp from now on
+		"""
+		self._backup_dir = self.path + _reserved[1] + '/' + stamp
+		self._backup_parents = set()
+
+	def backup_path(self, sub_path):
+		"""
+		Returns the path of sub_path in the current backup (None without backup) and creates its directory
+		"""
+		if getattr(self, '_backup_dir', None) == None:
+			return None
+
+		parent = sub_path.rsplit('/', 1)[0]
+		if parent not in self._backup_parents:
+			self._makedirs(self._backup_dir + parent)
+			self._backup_parents.add(parent)
+		return self._backup_dir + sub_path
+
+	def backups(self):
+		"""
+		Returns the sorted list with the stamps of all backups
+		"""
+		try:
+			return sorted(name for name, entry in self._listdir(self.path + _reserved[1]).items() if S_ISDIR(entry.mode))
+		except FileNotFoundError:
+			return []
+
+	def expire_backups(self, days, runs=0):
+		"""
+		Removes backups older than days and all but the newest runs backups (0 = no limit)
+		"""
+		stamps = self.backups()
+		oldest = time.strftime('%Y%m%d-%H%M%S', time.localtime(time.time() - days * 24 * 3600))
+		for pos, stamp in enumerate(stamps):
+			if stamp < oldest or (runs > 0 and pos < len(stamps) - runs):
+				logging.info("Remove backup '" + stamp + "' from '" + self._adr + "'")
+				self._rmtree(self.path + _reserved[1] + '/' + stamp)
+
+	def restore(self, sub_path, stamp=None):
+		"""
+		Moves sub_path back from the newest backup (or the backup stamp), which contains it
+
+		A current version of sub_path is moved to a new backup before. Returns the stamp of the restored backup or None.
+		"""
+		stamps = [backup for backup in self.backups() if stamp in [None, backup]]
+		for backup in reversed(stamps):
+			path = self.path + _reserved[1] + '/' + backup + sub_path.rstrip('/')
+			if not self._exists(path):
+				continue
+
+			logging.info("Restore '" + sub_path + "' from backup '" + backup + "'")
+			sub_path = sub_path.rstrip('/')
+			self._makedirs(self.path + sub_path.rsplit('/', 1)[0])
+			# Moved out first, the backup of the current version could have the same stamp
+			self._rename(path, self.path + _tmp_path(sub_path))
+			if self._exists(self.path + sub_path):
+				self.start_backup(time.strftime('%Y%m%d-%H%M%S'))
+				self._rename(self.path + sub_path, self.backup_path(sub_path))
+			self._rename(self.path + _tmp_path(sub_path), self.path + sub_path)
+			return backup
+		return None
+
+	def _start_dirs(self, config):
+		"""
+		Returns a list of tuples (sub_dir, _attr) of the directories, where the scan starts
+
+		Without paths in config it's the root. Otherwise the paths, their parent directories are only added.
+		"""
+		if len(config.paths) == 0:
+			return [('/', self._stat(self.path + '/'))]
+
+		start_dirs = []
+		for path in config.paths:
+			sub_dir = '/'
+			for name in path[1:-1].split('/'):
+				sub_dir += name + '/'
+				if not config.test_dir(sub_dir[:-1]):
+					break
+				try:
+					attr = self._stat(self.path + sub_dir)
+				except FileNotFoundError:
+					break
+				if not S_ISDIR(attr.mode):
+					break
+				self.add_folder(sub_dir, oct(attr.mode)[-3:])
+			else:
+				start_dirs.append((sub_dir, attr))
+		return start_dirs
+
+	def _find_files(self, config, callback=None):
 		paths_buf = []
-		paths = [self.path + '/']
+		paths = self._start_dirs(config)
 		while True:
-			for path in paths:
+			for sub_dir, attr in paths:
 				if callback != None:
-					callback('Read ' + self._path + '\n' + path)
-				for sub_path in os.listdir(path):
-					attr = os.stat(path + sub_path)
-					if S_ISDIR(attr.st_mode):
-						if config.test_dir(path[len(self.path):] + sub_path):
-							sub_path += '/'
-							self.add_folder(path[len(self.path):] + sub_path, oct(attr.st_mode)[-3:])
-							paths_buf.append(path + sub_path)
-					elif S_ISREG(attr.st_mode):
-						if config.test_file(path[len(self.path):] + sub_path):
-							self.add_file(path[len(self.path):] + sub_path, oct(attr.st_mode)[-3:], abs(int(attr.st_mtime)), attr.st_size)
+					callback('Read ' + self._adr + '\n' + self.path + sub_dir)
+				for name, entry in self._listdir(self.path + sub_dir).items():
+					sub_path = sub_dir + name
+					if sub_path in _reserved:
+						continue
+					if S_ISDIR(entry.mode):
+						if config.test_dir(sub_path):
+							self.add_folder(sub_path + '/', oct(entry.mode)[-3:])
+							paths_buf.append((sub_path + '/', entry))
+					elif S_ISREG(entry.mode):
+						if config.test_file(sub_path):
+							self.add_file(sub_path, oct(entry.mode)[-3:], abs(int(entry.mtime)), entry.size)
 			if len(paths_buf) == 0:
 				break
 			paths = paths_buf
 			paths_buf = []
 
-	def get_hash(self, sub_path):
-		return utils.get_hash("%s%s" % (self.path, sub_path))
-
 	@property
 	def path(self):
 		return self._path
 
-class SSHData(BasicData, paramiko.client.SSHClient):
-	def __init__(self, path, config, callback=None, policy=paramiko.client.RejectPolicy):
+	@property
+	def address(self):
+		"""
+		Returns the root like in the config (with ssh://user@host for remote roots)
+		"""
+		return self._adr
+
+class FSData(RootData):
+	# Files, which are hashed at the same time (hashlib releases the GIL)
+	_hash_threads = 4
+
+	def __init__(self, path, config, callback=None, scan=True):
+		logging.info("Init FSData with path: '" + path + "'")
+		super().__init__()
+		self._adr = path
+		self._path = path
+		if scan:
+			self._find_files(config, callback)
+
+	def _stat(self, path):
+		attr = os.stat(path)
+		return _attr(attr.st_mode, attr.st_mtime, attr.st_ctime, attr.st_size)
+
+	def _listdir(self, path):
+		entries = dict()
+		with os.scandir(path) as it:
+			for entry in it:
+				attr = entry.stat()
+				entries[entry.name] = _attr(attr.st_mode, attr.st_mtime, attr.st_ctime, attr.st_size)
+		return entries
+
+	def _makedirs(self, path):
+		os.makedirs(path, exist_ok=True)
+
+	def _rename(self, old_path, new_path):
+		os.rename(old_path, new_path)
+
+	def _rmtree(self, path):
+		shutil.rmtree(path)
+
+	def _tree(self, path):
+		def onerror(e):
+			raise e
+
+		tree = set()
+		for dirpath, dirnames, filenames in os.walk(path, onerror=onerror):
+			prefix = dirpath[len(path):]
+			if prefix != '':
+				prefix = prefix.lstrip('/') + '/'
+			tree.update(prefix + name + '/' for name in dirnames)
+			tree.update(prefix + name for name in filenames)
+		return tree
+
+	def keep(self, sub_path):
+		"""
+		Saves the current version of the file sub_path in the backup, before it's replaced
+
+		Does nothing without backup or if the file doesn't exist. Remote files are moved to the backup
+		with the rename, which replaces them.
+		"""
+		path = self.path + sub_path
+		if not isinstance(self[sub_path], DataFileType) or not os.path.isfile(path):
+			return
+		backup_path = self.backup_path(sub_path)
+		if backup_path == None:
+			return
+
+		# A hardlink or reflink costs no copy. The file itself is replaced by a rename afterwards
+		try:
+			os.link(path, backup_path)
+			return
+		except OSError:
+			pass
+		try:
+			with open(path, 'rb') as src, open(backup_path, 'wb') as dst:
+				fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+			shutil.copystat(path, backup_path)
+			return
+		except OSError:
+			os.remove(backup_path)
+		os.rename(path, backup_path)
+
+	def get_hash(self, sub_path):
+		digest = self.known_hash(sub_path)
+		if digest != None:
+			return digest
+		return utils.get_hash("%s%s" % (self.path, sub_path), self.hash_algorithm)
+
+	def get_hashes(self, sub_paths):
+		"""
+		Returns a dictionary with sub_path as key and the hash as value. Files which can't be read are missing
+
+		The files are hashed on a pool of threads.
+		"""
+		def get_hash(sub_path):
+			try:
+				return self.get_hash(sub_path)
+			except OSError as e:
+				logging.warning("Can't hash '" + sub_path + "': " + str(e))
+				return None
+
+		if len(sub_paths) <= 1:
+			results = [get_hash(sub_path) for sub_path in sub_paths]
+		else:
+			with concurrent.futures.ThreadPoolExecutor(min(self._hash_threads, len(sub_paths))) as pool:
+				results = list(pool.map(get_hash, sub_paths))
+		return dict((sub_path, digest) for sub_path, digest in zip(sub_paths, results) if digest != None)
+
+class _BlockReader(object):
+	"""
+	Reads a paramiko SFTPFile block by block, all requests of a block are send at once
+	"""
+	def __init__(self, f):
+		self._file = f
+		self._offset = 0
+
+	def seek(self, offset):
+		self._offset = offset
+
+	def read(self, size):
+		block = b''.join(self._file.readv([(self._offset, size)]))
+		self._offset += len(block)
+		return block
+
+class SFTPBatch(object):
+	"""
+	Sends SFTP requests without waiting for the answers
+
+	The server handles the requests in order. wait() collects the answers and returns
+	a list of tuples (path, exception or None) in the order of the requests.
+	"""
+	_max_outstanding = 64
+
+	def __init__(self, sftp_client):
+		self._sftp_client = sftp_client
+		self._requests = []
+		self._results = dict()
+
+	def _async_response(self, t, msg, num):
+		"""
+		Called by paramiko for every answer
+		"""
+		try:
+			if t == CMD_STATUS:
+				self._sftp_client._convert_status(msg)
+			self._results[num] = None
+		except (IOError, OSError) as e:
+			self._results[num] = e
+
+	def _request(self, path, t, *args):
+		# Don't let the server block on unread answers
+		while len(self._requests) - len(self._results) >= self._max_outstanding:
+			self._sftp_client._read_response()
+		num = self._sftp_client._async_request(self, t, *args)
+		self._requests.append((num, path))
+
+	def setstat(self, path, mode=None, mtime=None):
+		"""
+		Sets mode and/or mtime of path with one request
+		"""
+		attr = paramiko.SFTPAttributes()
+		if mode != None:
+			attr.st_mode = mode
+		if mtime != None:
+			attr.st_atime = attr.st_mtime = mtime
+		self._request(path, CMD_SETSTAT, self._sftp_client._adjust_cwd(path), attr)
+
+	def mkdir(self, path, mode):
+		attr = paramiko.SFTPAttributes()
+		attr.st_mode = mode
+		self._request(path, CMD_MKDIR, self._sftp_client._adjust_cwd(path), attr)
+
+	def rename(self, old_path, new_path):
+		"""
+		Renames old_path to new_path and overwrites new_path (posix-rename)
+		"""
+		self._request(old_path, CMD_EXTENDED, 'posix-rename@openssh.com', self._sftp_client._adjust_cwd(old_path), self._sftp_client._adjust_cwd(new_path))
+
+	def remove(self, path):
+		self._request(path, CMD_REMOVE, self._sftp_client._adjust_cwd(path))
+
+	def rmdir(self, path):
+		self._request(path, CMD_RMDIR, self._sftp_client._adjust_cwd(path))
+
+	def wait(self):
+		while len(self._results) < len(self._requests):
+			self._sftp_client._read_response()
+		return [(path, self._results[num]) for num, path in self._requests]
+
+class SSHData(RootData, paramiko.client.SSHClient):
+	_reconnect_attempts = 5
+	# Remote scripts (one channel each), which hash files at the same time
+	_hash_channels = 4
+	_hash_batch = 64
+
+	def __init__(self, path, config, callback=None, policy=paramiko.client.RejectPolicy, scan=True, save_listing=True):
 		logging.info("Init SSHData with path: '" + path + "'")
 
 		# Init
-		BasicData.__init__(self)
+		RootData.__init__(self)
 		paramiko.client.SSHClient.__init__(self)
 
 		# Load known_hosts
@@ -309,23 +1471,66 @@ class SSHData(BasicData, paramiko.client.SSHClient):
 		except IOError:
 			pass
 
-		self._ssh_adr = path
+		self._adr = path
 		self._host = None
 		self._port = 22
 		self._user = None
 		self._path = '/'
 
-		self._parse_adr(self._ssh_adr)
+		self._parse_adr(self._adr)
 		self.set_missing_host_key_policy(policy())
 
 		if callback != None:
-			callback('connect to ' + self._ssh_adr)
+			callback('connect to ' + self._adr)
+
+		self._connect()
+
+		self._remote_hashes = dict()
+		self._hash_cache = None
+		if config.remote_hash_cache:
+			self._hash_cache = RemoteHashCache(self._sftp_client, self.path)
+		# The listing of an incremental scan is saved for the next one
+		self._save_listing = save_listing
 
+		if scan:
+			self._find_files(config, callback)
+
+	def _connect(self):
 		self.connect(self._host, self._port, self._user, timeout=10)
 		self._sftp_client = self.open_sftp()
 		self._sftp_client.get_channel().settimeout(10)
 
-		self._find_files(config, callback)
+	@property
+	def connected(self):
+		"""
+		Returns False if the connection is lost
+		"""
+		transport = self.get_transport()
+		return transport != None and transport.is_active()
+
+	def reconnect(self, callback=None):
+		"""
+		Connects again after a lost connection
+
+		Waits 1, 2, 4, ... seconds between the attempts and raises the last error, if all attempts failed.
+		"""
+		delay = 1
+		for attempt in range(self._reconnect_attempts):
+			if callback != None:
+				callback('reconnect to ' + self._adr)
+			logging.warning("Reconnect to '" + self._adr + "' (attempt " + str(attempt + 1) + ")")
+			try:
+				paramiko.client.SSHClient.close(self)
+				self._connect()
+				if self._hash_cache != None:
+					self._hash_cache._sftp_client = self._sftp_client
+				return
+			except (socket.error, EOFError, paramiko.SSHException) as e:
+				if attempt == self._reconnect_attempts - 1:
+					raise
+				logging.warning("Reconnect failed: " + str(e))
+				time.sleep(delay)
+				delay *= 2
 
 	def _parse_adr(self, ssh_adr):
 		"""Returns a tuple with host, port, user and path from the parsed ssh adress"""
@@ -360,42 +1565,474 @@ class SSHData(BasicData, paramiko.client.SSHClient):
 		if 'hostname' in conf.lookup(self._host):
 			self._host = conf.lookup(self._host)['hostname']
 
+	def _stat(self, path):
+		attr = self._sftp_client.stat(path)
+		return _attr(attr.st_mode, attr.st_mtime, None, attr.st_size)
+
+	def _listdir(self, path):
+		entries = dict()
+		for attr in self._sftp_client.listdir_attr(path):
+			entries[attr.filename] = _attr(attr.st_mode, attr.st_mtime, None, attr.st_size)
+		return entries
+
 	def _find_files(self, config, callback=None):
-		paths_buf = []
-		paths = [self.path + '/']
-		while True:
-			for path in paths:
-				if callback != None:
-					callback('Read ' + self._ssh_adr + '\n' + path)
-				for sub_path in self._sftp_client.listdir_attr(path):
-					if S_ISDIR(sub_path.st_mode):
-						if config.test_dir(path[len(self.path):] + sub_path.filename):
-							sub_path.filename += '/'
-							self.add_folder(path[len(self.path):] + sub_path.filename, oct(sub_path.st_mode)[-3:])
-							paths_buf.append(path + sub_path.filename)
-					elif S_ISREG(sub_path.st_mode):
-						if config.test_file(path[len(self.path):] + sub_path.filename):
-							self.add_file(path[len(self.path):] + sub_path.filename, oct(sub_path.st_mode)[-3:], abs(int(sub_path.st_mtime)), sub_path.st_size)
-			if len(paths_buf) == 0:
-				break
-			paths = paths_buf
-			paths_buf = []
+		"""
+		Reads the root with SFTP or with an incremental scan (see ListingCache)
 
-	def get_hash(self, sub_path):
-		stdin, stdout, stderr = self.exec_command('sha1sum "' + self.path + sub_path + '"')
+		Without GNU find on the server, the incremental scan falls back to SFTP.
+		"""
+		if not config.incremental_scan:
+			return super()._find_files(config, callback)
+
+		cache = ListingCache(config, self._adr)
+		try:
+			for sub_dir, _ in self._start_dirs(config):
+				clock = self._scan_changes(cache, sub_dir, callback)
+				visited = set()
+				walked = [sub_dir]
+				while len(walked) > 0:
+					missing = []
+					for start in walked:
+						visited.add(start)
+						for sub_path, entry, listed in self._walk_listing(config, cache, start):
+							if S_ISDIR(entry[0]):
+								self.add_folder(sub_path, oct(entry[0])[-3:])
+								visited.add(sub_path)
+								if not listed:
+									missing.append(sub_path)
+							else:
+								self.add_file(sub_path, oct(entry[0])[-3:], entry[1], entry[2])
+					# New, moved or no longer ignored directories are read with all their content
+					if len(missing) > 0:
+						if callback != None:
+							callback('Read ' + self._adr + '\n' + str(len(missing)) + ' new directories')
+						starts = ' '.join(shlex.quote('.' + sub_path.rstrip('/')) for sub_path in missing)
+						self._apply_listing(cache, self._listing_script(['find %s -printf %s' % (starts, self._listing_format('F'))])[1])
+					walked = missing
+				cache.scanned(sub_dir, clock, visited)
+		except (IOError, ValueError) as e:
+			logging.warning("Incremental scan of '" + self._adr + "' failed, read it with SFTP: " + str(e))
+			self._clear()
+			return super()._find_files(config, callback)
+
+		if self._save_listing:
+			cache.save()
+
+	def _scan_changes(self, cache, sub_dir, callback=None):
+		"""
+		Updates the listings of cache below sub_dir and returns the clock of the server at the start
+
+		Only the entries changed since the last scan and the entries of the changed directories are listed.
+		Without listing of sub_dir, everything below it is listed. Raises IOError if the script fails.
+		"""
+		if callback != None:
+			callback('Read changes of ' + self._adr + '\n' + self.path + sub_dir)
+		start = shlex.quote('.' + sub_dir.rstrip('/'))
+		# The reserved files of the root aren't read
+		prune = '\\( %s \\) -prune -o' % ' -o '.join('-path ' + shlex.quote('.' + path) for path in _reserved)
+		clock = cache.clock(sub_dir)
+		if clock == None:
+			now, records = self._listing_script(['find %s %s -printf %s' % (start, prune, self._listing_format('F'))])
+			self._apply_listing(cache, records)
+			return now
+
+		# Changes in the same second as the last scan started could be missing, they are read again
+		newer = '-newerct @%d' % (clock - 1)
+		children = 'exec find "$@" -mindepth 1 -maxdepth 1 -printf ' + self._listing_format('L')
+		now, records = self._listing_script([
+			'find %s -maxdepth 0 -printf %s' % (start, self._listing_format('S')),
+			'find %s %s %s -printf %s' % (start, prune, newer, self._listing_format('C')),
+			'find %s %s -type d %s -print0 | xargs -0 -r sh -c %s sh' % (start, prune, newer, shlex.quote(children))])
+		if any(tag == 'S' and entry[3] != cache.dirs[sub_dir][0] for tag, _, entry in records):
+			# Another directory (e.g. replaced), it's read fully
+			del cache.dirs[sub_dir]
+			return self._scan_changes(cache, sub_dir, callback)
+		self._apply_listing(cache, records)
+		return now
+
+	@staticmethod
+	def _listing_format(tag):
+		"""
+		Returns the quoted format of find -printf for an entry: tag, type, inode, mode, mtime, size and path (with \\0 at the end)
+		"""
+		return shlex.quote(tag + ' %y %i %m %T@ %s %p\\0')
 
+	def _listing_script(self, commands):
+		"""
+		Executes the find commands in the root and returns a tuple with the clock of the server
+		at the start and a list of tuples (tag, sub_path, (mode, mtime, size, inode)) of the listed entries
+
+		Raises IOError if a command fails.
+		"""
+		script = ['cd -- %s || exit 1' % shlex.quote(self.path + '/'), 'date +%s']
+		script += [command + ' || exit 1' for command in commands]
+		stdin, stdout, stderr = self.exec_command('sh -s')
+		stdin.write('\n'.join(script) + '\n')
+		stdin.channel.shutdown_write()
+		output = stdout.read()
+		err = stderr.read()
+		if stdout.channel.recv_exit_status() != 0:
+			raise IOError(err.decode(errors='replace').strip())
+
+		now, output = output.split(b'\n', 1)
+		records = []
+		for record in output.decode().split('\0')[:-1]:
+			tag, kind, inode, mode, mtime, size, path = record.split(' ', 6)
+			if kind == 'd':
+				mode = S_IFDIR | int(mode, 8)
+			elif kind == 'f':
+				mode = S_IFREG | int(mode, 8)
+			else:
+				continue
+			# Paths start with the . of the root
+			records.append((tag, path[1:], (mode, abs(int(float(mtime))), int(size), int(inode))))
+		return int(now), records
+
+	@staticmethod
+	def _apply_listing(cache, records):
+		"""
+		Saves the entries of records (see _listing_script) in the listings of cache
+
+		Directories, which were read fully (F) or changed (C) get a new listing, which is filled with their entries.
+		"""
+		for tag, sub_path, entry in records:
+			if tag in ['F', 'C'] and S_ISDIR(entry[0]):
+				cache.dirs[sub_path + '/'] = (entry[3], dict())
+		for tag, sub_path, entry in records:
+			parent, name = sub_path.rsplit('/', 1) if len(sub_path) > 0 else ('', '')
+			if len(name) > 0 and parent + '/' in cache.dirs:
+				cache.dirs[parent + '/'][1][name] = entry
+
+	@staticmethod
+	def _walk_listing(config, cache, sub_dir):
+		"""
+		Yields (sub_path, entry, listed) of the saved entries below sub_dir, which aren't ignored by config
+
+		listed is False for directories without listing of their own (by inode), they aren't walked.
+		"""
+		sub_dirs = [sub_dir]
+		while len(sub_dirs) > 0:
+			parent = sub_dirs.pop()
+			for name, entry in cache.dirs[parent][1].items():
+				sub_path = parent + name
+				if sub_path in _reserved:
+					continue
+				if S_ISDIR(entry[0]):
+					if config.test_dir(sub_path):
+						listing = cache.dirs.get(sub_path + '/')
+						listed = listing != None and listing[0] == entry[3]
+						yield sub_path + '/', entry, listed
+						if listed:
+							sub_dirs.append(sub_path + '/')
+				elif S_ISREG(entry[0]):
+					if config.test_file(sub_path):
+						yield sub_path, entry, True
+
+	def supports_hash(self, algorithm):
+		"""
+		Returns True if the hash algorithm is supported local and by the remote side
+		"""
+		if not super().supports_hash(algorithm):
+			return False
+		if algorithm not in self._remote_hashes:
+			command = utils.HASH_ALGORITHMS[algorithm][1]
+			self._remote_hashes[algorithm] = self._exec('command -v ' + command + ' >/dev/null && echo yes').strip() == 'yes'
+		return self._remote_hashes[algorithm]
+
+	def _exec(self, command, input=None):
+		"""
+		Executes command on the remote side and returns stdout as string
+
+		input is an optional string, which is send to stdin of the command.
+		"""
+		stdin, stdout, stderr = self.exec_command(command)
+		if input != None:
+			stdin.write(input)
+			stdin.channel.shutdown_write()
+
+		data = stdout.read()
 		err = stderr.read()
 		if len(err) > 0:
-			print('Error returned:', err)
-		data = stdout.read().decode()
-		data, _ = data.split(' ', 1)
-		return data
+			logging.warning("Error returned: " + err.decode(errors='replace'))
+		return data.decode()
+
+	def get_hash(self, sub_path):
+		hashes = self.get_hashes([sub_path])
+		if sub_path not in hashes:
+			raise IOError("Can't hash '" + self.path + sub_path + "'")
+		return hashes[sub_path]
+
+	def get_hashes(self, sub_paths):
+		"""
+		Returns a dictionary with sub_path as key and the hash as value. Files which can't be read are missing
+
+		All files are read with one remote script (with the hash cache) and hashed with up to _hash_channels scripts
+		in parallel, each on its own channel. The scripts are send over stdin.
+		"""
+		hashes = dict()
+		keys = dict()
+		for sub_path in sub_paths:
+			if self.known_hash(sub_path) != None:
+				hashes[sub_path] = self.known_hash(sub_path)
+
+		if self._hash_cache != None:
+			# The remote time is needed to skip files, which were changed in the current second
+			script = ['echo %d $(stat -c %%i:%%s:%%Y -- %s)' % (pos, shlex.quote(self.path + sub_path)) for pos, sub_path in enumerate(sub_paths) if sub_path not in hashes]
+			script.append('echo now $(date +%s)')
+			now = None
+			for line in self._exec('sh -s', '\n'.join(script) + '\n').splitlines():
+				line = line.split()
+				if len(line) != 2:
+					continue
+				if line[0] == 'now':
+					now = int(line[1])
+					continue
+				# Hashes of different algorithms are never mixed
+				keys[sub_paths[int(line[0])]] = '%s:%s' % (self.hash_algorithm, line[1])
+
+			for sub_path, key in list(keys.items()):
+				if self._hash_cache.get(key) != None:
+					hashes[sub_path] = self._hash_cache.get(key)
+				elif now == None or int(key.rsplit(':', 1)[1]) >= now:
+					del keys[sub_path]
+
+		command = utils.HASH_ALGORITHMS[self.hash_algorithm][1]
+		script = ['echo %d $(%s < %s)' % (pos, command, shlex.quote(self.path + sub_path)) for pos, sub_path in enumerate(sub_paths) if sub_path not in hashes]
+		# Small numbers of files aren't worth more channels
+		channels = max(1, min(self._hash_channels, len(script) // self._hash_batch))
+		scripts = ['\n'.join(script[i::channels]) + '\n' for i in range(channels) if len(script[i::channels]) > 0]
+		with concurrent.futures.ThreadPoolExecutor(channels) as pool:
+			outputs = list(pool.map(lambda script: self._exec('sh -s', script), scripts))
+		for output in outputs:
+			for line in output.splitlines():
+				line = line.split()
+				if len(line) < 2:
+					continue
+				sub_path = sub_paths[int(line[0])]
+				hashes[sub_path] = line[1]
+				if sub_path in keys:
+					self._hash_cache.set(keys[sub_path], line[1])
+
+		return hashes
+
+	def hash_tmp(self, sub_path_tmp, data):
+		"""
+		Returns the hash of the temporary file sub_path_tmp (None if it can't be read)
+
+		data are the attributes of the file after the rename. The hash is saved in the hash cache with them.
+		"""
+		tmp = shlex.quote(self.path + sub_path_tmp)
+		command = utils.HASH_ALGORITHMS[self.hash_algorithm][1]
+		line = self._exec('echo $(stat -c %%i:%%s -- %s) $(date +%%s) $(%s < %s)' % (tmp, command, tmp)).split()
+		if len(line) < 3:
+			return None
+
+		# The inode stays the same with the rename, the mtime is set to data.mtime
+		if self._hash_cache != None and data.mtime < int(line[1]):
+			self._hash_cache.set('%s:%s:%d' % (self.hash_algorithm, line[0], data.mtime), line[2])
+		return line[2]
+
+	def put_bundle(self, localroot, files, digests=None, limiter=None):
+		"""
+		Transfers local files in one tar stream to temporary files and renames them afterwards
+
+		files is a list of tuples (sub_path, sub_path_tmp), relative to localroot and the remote root.
+		With the dictionary digests, the hash of every file is computed while it's send and compared
+		with the hash of the temporary file before the rename. The hashes are saved in digests.
+		The files are read with the optional RateLimiter limiter.
+		Returns a tuple with the list of committed sub_paths and a list of (sub_path, message) for failed files.
+		"""
+		sizes = dict()
+		stdin, stdout, stderr = self.exec_command('tar -x -p --no-same-owner -f - -C ' + shlex.quote(self.path))
+		with tarfile.open(fileobj=stdin, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+			for sub_path, sub_path_tmp in files:
+				try:
+					f = open(localroot + sub_path, 'rb')
+				except OSError as e:
+					logging.warning("Can't bundle '" + sub_path + "': " + str(e))
+					continue
+				with f:
+					info = tar.gettarinfo(arcname=sub_path_tmp[1:], fileobj=f)
+					info.uid = info.gid = 0
+					info.uname = info.gname = ''
+					if limiter != None:
+						f = utils.RateReader(f, limiter)
+					if digests != None:
+						f = utils.HashReader(f, utils.HASH_ALGORITHMS[self.hash_algorithm][0]())
+					tar.addfile(info, f)
+					sizes[sub_path] = info.size
+					if digests != None:
+						digests[sub_path] = f.digest.hexdigest()
+		stdin.channel.shutdown_write()
+		err = stderr.read()
+		if stdout.channel.recv_exit_status() != 0:
+			logging.warning("tar returned: " + err.decode(errors='replace'))
+
+		# Commit every temporary file with the expected size. The script is send over stdin (no limit for the length)
+		script = []
+		for pos, (sub_path, sub_path_tmp) in enumerate(files):
+			if sub_path not in sizes:
+				continue
+			tmp = shlex.quote(self.path + sub_path_tmp)
+			path = shlex.quote(self.path + sub_path)
+			# The current version is linked (or moved) to the backup
+			backup = ''
+			if isinstance(self[sub_path], DataFileType) and self.backup_path(sub_path) != None:
+				backup_path = shlex.quote(self.backup_path(sub_path))
+				backup = '{ [ ! -f %s ] || ln -f -- %s %s 2>/dev/null || mv -f -- %s %s; } && ' % (path, path, backup_path, path, backup_path)
+			check = '[ "$(stat -c %%s -- %s)" = %d ]' % (tmp, sizes[sub_path])
+			if digests != None:
+				check = '[ "$(%s < %s | cut -d " " -f 1)" = %s ]' % (utils.HASH_ALGORITHMS[self.hash_algorithm][1], tmp, digests[sub_path])
+			script.append('%s && %smv -f -- %s %s && echo %d || rm -f -- %s' % (check, backup, tmp, path, pos, tmp))
+		stdin, stdout, stderr = self.exec_command('sh -s')
+		stdin.write('\n'.join(script) + '\n')
+		stdin.channel.shutdown_write()
+		committed = set(int(pos) for pos in stdout.read().decode().split())
+
+		synced = [files[pos][0] for pos in sorted(committed)]
+		errors = [(sub_path, 'bundled transfer failed') for pos, (sub_path, _) in enumerate(files) if pos not in committed]
+		return synced, errors
+
+	def get_bundle(self, localroot, files, keep=None, digests=None, limiter=None):
+		"""
+		Transfers remote files in one tar stream to local temporary files and renames them afterwards
+
+		files is a list of tuples (sub_path, sub_path_tmp), relative to the remote root and localroot.
+		keep(sub_path) is called before a local file is replaced (for backups).
+		With the dictionary digests, the hash of every file is computed while it's received and compared
+		with the hash of the remote file (all hashed in one script) before the rename. The hashes are saved in digests.
+		The stream is read with the optional RateLimiter limiter.
+		Returns a tuple with the list of committed sub_paths and a list of (sub_path, message) for failed files.
+		"""
+		tmp_paths = dict(('./' + sub_path[1:], (sub_path, sub_path_tmp)) for sub_path, sub_path_tmp in files)
+		synced = []
+		if digests != None:
+			remote_hashes = self.get_hashes([sub_path for sub_path, _ in files])
+
+		# The names are send over stdin (no limit for the length)
+		stdin, stdout, stderr = self.exec_command('tar -c -f - -C ' + shlex.quote(self.path) + ' --null -T -')
+		stdin.write(''.join('%s\0' % name for name in tmp_paths))
+		stdin.channel.shutdown_write()
+		stream = stdout
+		if limiter != None:
+			stream = utils.RateReader(stdout, limiter)
+		with tarfile.open(fileobj=stream, mode='r|') as tar:
+			for info in tar:
+				if info.name not in tmp_paths or not info.isreg():
+					continue
+				sub_path, sub_path_tmp = tmp_paths[info.name]
+				try:
+					src = tar.extractfile(info)
+					if digests != None:
+						src = utils.HashReader(src, utils.HASH_ALGORITHMS[self.hash_algorithm][0]())
+					with open(localroot + sub_path_tmp, 'wb') as f:
+						shutil.copyfileobj(src, f)
+					if digests != None:
+						if src.digest.hexdigest() != remote_hashes.get(sub_path):
+							raise IOError("the copy has another hash than the source")
+						digests[sub_path] = src.digest.hexdigest()
+					os.chmod(localroot + sub_path_tmp, info.mode & 0o7777)
+					os.utime(localroot + sub_path_tmp, times=(info.mtime, info.mtime))
+					if keep != None:
+						keep(sub_path)
+					os.rename(localroot + sub_path_tmp, localroot + sub_path)
+					synced.append(sub_path)
+				except OSError as e:
+					logging.warning("Can't write '" + sub_path + "': " + str(e))
+					try:
+						os.remove(localroot + sub_path_tmp)
+					except OSError:
+						pass
+		err = stderr.read()
+		if stdout.channel.recv_exit_status() != 0:
+			logging.warning("tar returned: " + err.decode(errors='replace'))
+
+		errors = [(sub_path, 'bundled transfer failed') for sub_path, _ in files if sub_path not in synced]
+		return synced, errors
+
+	def _makedirs(self, path):
+		self._exec('mkdir -p -- ' + shlex.quote(path))
+
+	def _rename(self, old_path, new_path):
+		self._sftp_client.posix_rename(old_path, new_path)
 
-	def sftp_get(self, remotepath, localpath, callback=None):
-		self._sftp_client.get(remotepath, localpath, callback)
+	def _rmtree(self, path):
+		if self._exec('rm -rf -- %s && echo OK' % shlex.quote(path)).strip() != 'OK':
+			raise IOError("Can't remove '" + path + "'")
 
-	def sftp_put(self, localpath, remotepath, callback=None):
-		self._sftp_client.put(localpath, remotepath, callback)
+	def _tree(self, path):
+		# Names separated by NUL, directories with a final /. OK at the end if everything was read
+		output = self._exec("cd -- %s && find . -mindepth 1 \\( -type d -printf '%%P/\\0' -o -printf '%%P\\0' \\) && echo OK" % shlex.quote(path))
+		if not output.endswith('OK\n'):
+			raise IOError("Can't list '" + path + "'")
+		return set(name for name in output[:-3].split('\0') if name != '')
+
+	def measure_link(self, size=64 * 1024, count=3):
+		"""
+		Returns a dictionary with the round trip time (seconds) and the upload and download rate (bytes per second)
+
+		Nothing is written on the remote side, the data is read from /dev/zero and written to /dev/null.
+		The probe is small (size bytes each way), the rates are only a rough guess for fast links.
+		"""
+		rtts = []
+		for _ in range(count):
+			start = time.monotonic()
+			self._sftp_client.stat(self.path + '/')
+			rtts.append(time.monotonic() - start)
+		rtt = min(rtts)
+
+		start = time.monotonic()
+		stdin, stdout, stderr = self.exec_command('head -c %d /dev/zero' % size)
+		while len(stdout.read(65536)) > 0:
+			pass
+		# Opening the channel takes about two round trips
+		download = size / max(time.monotonic() - start - 2 * rtt, 0.001)
+
+		start = time.monotonic()
+		stdin, stdout, stderr = self.exec_command('cat > /dev/null')
+		block = bytes(65536)
+		for _ in range(0, size, len(block)):
+			stdin.write(block)
+		stdin.channel.shutdown_write()
+		stdout.channel.recv_exit_status()
+		upload = size / max(time.monotonic() - start - 2 * rtt, 0.001)
+
+		logging.info("Link to '" + self._adr + "': rtt %.3f s, upload %d B/s, download %d B/s" % (rtt, upload, download))
+		return {'rtt': rtt, 'upload': upload, 'download': download}
+
+	def batch(self):
+		"""
+		Returns a new SFTPBatch for this connection
+		"""
+		return SFTPBatch(self._sftp_client)
+
+	def sftp_get(self, remotepath, localpath, callback=None, digest=None, limiter=None):
+		"""
+		Copies remotepath to localpath, blocks with only zeros are written as holes
+
+		digest is an optional hash object, which is updated with the content.
+		limiter is an optional RateLimiter for the transfer.
+		"""
+		with self._sftp_client.open(remotepath, 'rb') as src, open(localpath, 'wb') as dst:
+			size = src.stat().st_size
+			reader = src
+			if limiter == None:
+				src.prefetch(size)
+			else:
+				# A prefetch of the whole file would ignore the limit
+				reader = _BlockReader(src)
+			utils.copy_sparse(reader, dst, size, callback, digest=digest, limiter=limiter)
+
+	def sftp_put(self, localpath, remotepath, callback=None, digest=None, limiter=None):
+		"""
+		Copies localpath to remotepath, holes and blocks with only zeros are not transfered
+
+		digest is an optional hash object, which is updated with the content.
+		limiter is an optional RateLimiter for the transfer.
+		"""
+		with open(localpath, 'rb') as src, self._sftp_client.open(remotepath, 'wb') as dst:
+			dst.set_pipelined(True)
+			utils.copy_sparse(src, dst, os.fstat(src.fileno()).st_size, callback, digest=digest, limiter=limiter)
 
 	def sftp_rename(self, old_path, new_path):
 		self._sftp_client.rename(old_path, new_path)
@@ -415,12 +2052,8 @@ class SSHData(BasicData, paramiko.client.SSHClient):
 	def rmdir(self, path):
 		self._sftp_client.rmdir(path)
 
-	def remove(self, path):
-		self._sftp_client.remove(path)
-
-	def close(self):
+	def close(self, save=True):
+		if self._hash_cache != None and save:
+			self._hash_cache.save()
 		self._sftp_client.close()
 
-	@property
-	def path(self):
-		return self._path
@@ -0,0 +1,110 @@
+from twosync import data, progress
+import math
+
+# Assumed rate of copies between local roots (bytes per second)
+LOCAL_RATE = 100 * 1024 * 1024
+# Assumed rate of hashing files (bytes per second), both roots are hashed at the same time
+HASH_RATE = 200 * 1024 * 1024
+
+# Round trips of an operation with a remote root (properties are send in batches)
+_round_trips = {'copy': 3, 'mkdir': 1, 'remove': 1, 'rmdir': 1, 'tree': 4, 'bundle': 4}
+
+_counters = {'copy': 'files', 'mkdir': 'folders', 'properties': 'properties', 'remove': 'removed files',
+	'rmdir': 'removed folders', 'tree': 'removed trees', 'bundle': 'bundles'}
+
+def _capped(rate, limit):
+	"""
+	Returns rate, capped by limit (0 = not limited)
+	"""
+	if limit > 0:
+		return min(rate, limit)
+	return rate
+
+def estimate(sync, links=None, operations=False):
+	"""
+	Returns the costs of the pending operations of sync (a SyncData) as dictionary for json, without syncing anything
+
+	links is a dictionary with remote roots as key and the result of their measure_link as value.
+	The time of a remote operation is its round trips and its bytes at the measured rate. Without measured link,
+	only its bytes are counted. The rates are capped by the current rate limits of sync. With operations=True, the list of operations is added.
+	Files with only another mtime, which sync hasn't hashed yet (verify_mtime=False), are counted as hashed files.
+	"""
+	if links == None:
+		links = dict()
+
+	directions = dict()
+	listed = []
+	for operation, sub_path, src_data, dst_data, items, size in sync.operations():
+		key = (src_data, dst_data)
+		if key not in directions:
+			directions[key] = dict([('source', src_data.address), ('destination', dst_data.address), ('items', 0), ('bytes', 0)]
+				+ [(counter, 0) for counter in _counters.values()] + [('hashed files', 0), ('hashed bytes', 0), ('round trips', 0), ('seconds', 0.0)])
+		direction = directions[key]
+		direction['items'] += items
+		direction['bytes'] += size
+		direction[_counters[operation]] += 1
+		if operations:
+			listed.append([operation, sub_path, src_data.address, dst_data.address, items, size])
+
+	for (src_data, dst_data), sub_paths in sync.unverified.items():
+		direction = directions[(src_data, dst_data)]
+		direction['hashed files'] = len(sub_paths)
+		direction['hashed bytes'] = sum(src_data[sub_path].size for sub_path in sub_paths)
+
+	for (src_data, dst_data), direction in directions.items():
+		hash_seconds = direction['hashed bytes'] / HASH_RATE
+		limit = 0
+		limiter = sync.limiter(src_data, dst_data)
+		if limiter != None:
+			limit = limiter.rate()
+		remote = dst_data if isinstance(dst_data, data.SSHData) else src_data
+		if not isinstance(remote, data.SSHData):
+			direction['seconds'] = hash_seconds + direction['bytes'] / _capped(LOCAL_RATE, limit)
+			continue
+
+		round_trips = sum(_round_trips[operation] * direction[counter] for operation, counter in _counters.items() if operation in _round_trips)
+		round_trips += math.ceil(direction['properties'] / sync._batch_items)
+		if direction['hashed files'] > 0:
+			# The remote files are hashed by one script
+			round_trips += 1
+		if sync.verify:
+			round_trips += direction['files']
+		direction['round trips'] = round_trips
+
+		link = links.get(remote)
+		if link != None:
+			rate = link['upload'] if remote is dst_data else link['download']
+			direction['seconds'] = hash_seconds + round_trips * link['rtt'] + direction['bytes'] / _capped(rate, limit)
+		elif limit > 0:
+			direction['seconds'] = hash_seconds + direction['bytes'] / limit
+		else:
+			direction['seconds'] = hash_seconds
+
+	report = {
+		'directions': list(directions.values()),
+		'items': sum(direction['items'] for direction in directions.values()),
+		'bytes': sum(direction['bytes'] for direction in directions.values()),
+		'avoided bytes': sync.avoided_bytes,
+		'hashed bytes': sum(direction['hashed bytes'] for direction in directions.values()),
+		'seconds': sum(direction['seconds'] for direction in directions.values()),
+		'links': dict((root.address, link) for root, link in links.items()),
+	}
+	if operations:
+		report['operations'] = listed
+	return report
+
+def format_report(report):
+	"""
+	Returns report (from estimate) as human readable text
+	"""
+	lines = []
+	for direction in report['directions']:
+		counts = ', '.join('%d %s' % (direction[counter], counter) for counter in _counters.values() if direction[counter] > 0)
+		lines.append('%s -> %s: %s (%s)' % (direction['source'], direction['destination'], progress.format_size(direction['bytes']), counts))
+	seconds = report['seconds']
+	lines.append('%d items, %s, about %d:%02d:%02d' % (report['items'], progress.format_size(report['bytes']), seconds // 3600, seconds % 3600 // 60, seconds % 60))
+	if report['avoided bytes'] > 0:
+		lines.append('%s not copied, only mtime changed' % progress.format_size(report['avoided bytes']))
+	if report['hashed bytes'] > 0:
+		lines.append('%s with changed mtime are hashed first, copied only if the content changed' % progress.format_size(report['hashed bytes']))
+	return '\n'.join(lines)
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+ProgressState = namedtuple('ProgressState', 'items_done, items_total, bytes_done, bytes_total, sub_path, rate, eta')
+
+class Progress(object):
+	"""
+	Collects the progress of a sync and reports it to listeners
+
+	Items and bytes can be added from several threads. The listeners are called with a ProgressState,
+	but not more often than every interval seconds (except the last state on close).
+	rate is in bytes per second, eta in seconds (None if unknown).
+	"""
+	def __init__(self, items_total=0, bytes_total=0, interval=0.2):
+		self._lock = threading.Lock()
+		self._listeners = []
+		self._interval = interval
+		self._items_total = items_total
+		self._bytes_total = bytes_total
+		self._items_done = 0
+		self._bytes_done = 0
+		self._sub_path = ''
+		self._started = time.monotonic()
+		self._emitted = 0
+		self._cancelled = False
+
+	def reset(self, items_total, bytes_total):
+		"""
+		Sets new totals and starts again
+		"""
+		with self._lock:
+			self._items_total = items_total
+			self._bytes_total = bytes_total
+			self._items_done = 0
+			self._bytes_done = 0
+			self._started = time.monotonic()
+
+	def add_listener(self, listener):
+		self._listeners.append(listener)
+
+	def start_item(self, sub_path):
+		"""
+		Sets the item, which is synced now. Raises InterruptedError if the sync was cancelled
+		"""
+		self.check()
+		with self._lock:
+			self._sub_path = sub_path
+		self._emit()
+
+	def finish_item(self, count=1):
+		with self._lock:
+			self._items_done += count
+		self._emit()
+
+	def add_bytes(self, count):
+		with self._lock:
+			self._bytes_done += count
+		self._emit()
+
+	def transfer_callback(self):
+		"""
+		Returns a callback(transferred, total) for one transfer (like the paramiko callback)
+
+		The callback adds the new transferred bytes and raises InterruptedError if the sync was cancelled.
+		"""
+		last = [0]
+		def callback(transferred, total):
+			self.check()
+			self.add_bytes(transferred - last[0])
+			last[0] = transferred
+		return callback
+
+	def cancel(self):
+		self._cancelled = True
+
+	@property
+	def cancelled(self):
+		return self._cancelled
+
+	def check(self):
+		"""
+		Raises InterruptedError if the sync was cancelled
+		"""
+		if self._cancelled:
+			raise InterruptedError
+
+	def state(self):
+		"""
+		Returns the current ProgressState
+		"""
+		with self._lock:
+			elapsed = time.monotonic() - self._started
+			rate = self._bytes_done / elapsed if elapsed > 0 else 0
+
+			eta = None
+			if self._bytes_total > 0 and rate > 0:
+				eta = max(0, self._bytes_total - self._bytes_done) / rate
+			elif self._bytes_total == 0 and self._items_done > 0:
+				eta = max(0, self._items_total - self._items_done) * elapsed / self._items_done
+
+			return ProgressState(self._items_done, self._items_total, self._bytes_done, self._bytes_total, self._sub_path, rate, eta)
+
+	def close(self):
+		"""
+		Reports the last state to all listeners
+		"""
+		self._emit(True)
+
+	def _emit(self, force=False):
+		now = time.monotonic()
+		with self._lock:
+			if not force and now - self._emitted < self._interval:
+				return
+			self._emitted = now
+
+		state = self.state()
+		for listener in self._listeners:
+			listener(state)
+
+def fraction(state):
+	"""
+	Returns the done part of state as float between 0 and 1 (by bytes if known, otherwise by items)
+	"""
+	if state.bytes_total > 0:
+		return min(1.0, state.bytes_done / state.bytes_total)
+	if state.items_total > 0:
+		return min(1.0, state.items_done / state.items_total)
+	return 0.0
+
+def format_size(size):
+	"""
+	Returns size in bytes as human readable string
+	"""
+	for unit in ['B', 'KiB', 'MiB', 'GiB']:
+		if size < 1024:
+			return '%.1f %s' % (size, unit)
+		size /= 1024
+	return '%.1f TiB' % size
+
+def format_state(state):
+	"""
+	Returns state as human readable text
+	"""
+	text = '%s\n%d of %d items, %s of %s, %s/s' % (state.sub_path, state.items_done, state.items_total,
+		format_size(state.bytes_done), format_size(state.bytes_total), format_size(state.rate))
+	if state.eta != None:
+		text += ', %d:%02d:%02d left' % (state.eta // 3600, state.eta % 3600 // 60, state.eta % 60)
+	return text
+
+def log_listener(state):
+	"""
+	Listener, which writes the progress to the log
+	"""
+	logging.info("Progress: " + format_state(state).replace('\n', ' - '))
+
+def print_listener(state):
+	"""
+	Listener, which prints the progress to stdout (for the command line)
+	"""
+	print('%3d%% %s' % (fraction(state) * 100, format_state(state).replace('\n', ' - ')), flush=True)
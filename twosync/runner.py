@@ -0,0 +1,194 @@
+from twosync import data, estimate, utils
+import logging
+import paramiko
+
+def open_roots(config, callback=None, policy=paramiko.client.RejectPolicy, scan=True, save_listing=True):
+	"""
+	Returns a list with the FSData/SSHData of both roots of config
+
+	With scan=False the roots are only connected, but not read. With save_listing=False the listing
+	of a remote root isn't saved for the next incremental scan.
+	"""
+	roots = []
+	for root in config.roots:
+		if root.startswith('ssh://'):
+			roots.append(data.SSHData(root, config, callback, policy, scan=scan, save_listing=save_listing))
+		else:
+			roots.append(data.FSData(root, config, callback, scan=scan))
+	return roots
+
+def record(datas, sub_path, value):
+	"""
+	Saves value as the synced state of sub_path in all datas
+	"""
+	for _data in datas:
+		if isinstance(value, data.DataNoneType):
+			if sub_path in _data.data:
+				_data.remove(sub_path)
+		else:
+			_data.add(sub_path, value)
+
+def run(config, pdata, roots, sync, progress=None, on_error=None):
+	"""
+	Syncs all items of sync (a SyncData) and saves the results in pdata and the destination roots
+
+	Every synced item is saved as checkpoint of a SyncPlan, so an aborted run can be resumed.
+	If a ssh connection is lost, it is reconnected and the failed item is tried again.
+	All other errors are passed to on_error(exception) (or raised, if on_error is None).
+	Returns the list of synced sub_paths. Errors of single files in bundles are in sync.errors.
+	"""
+	plan = data.SyncPlan(config)
+	plan.create(sync.items, roots)
+
+	synced = []
+	try:
+		while not sync.finished():
+			try:
+				done = sync.sync_next(progress)
+			except InterruptedError:
+				break
+			except Exception as e:
+				lost = [root for root in roots if isinstance(root, data.SSHData) and not root.connected]
+				if len(lost) == 0:
+					if on_error == None:
+						raise
+					on_error(e)
+					continue
+
+				# Raises if the connection can't be established again. The plan stays for a resume.
+				logging.warning("Connection lost: " + str(e))
+				retry = sync.retry()
+				for root in lost:
+					root.reconnect()
+				for root in roots:
+					root.refresh(retry)
+				continue
+
+			plan.checkpoint(done)
+			synced.extend(done)
+	finally:
+		plan.close()
+
+		done = set(synced)
+		with pdata.deferred_save():
+			for sub_path, src_data, dst_data in sync.items:
+				if sub_path in done:
+					record([pdata, dst_data], sub_path, src_data[sub_path])
+
+	if sync.finished():
+		plan.finish()
+
+	if config.backup_days > 0:
+		for root in roots:
+			root.expire_backups(config.backup_days, config.backup_runs)
+
+	return synced
+
+def resume(config, progress=None, on_error=None, callback=None, policy=paramiko.client.RejectPolicy):
+	"""
+	Continues the saved, aborted sync run of config without scanning the roots
+
+	Only the paths of the saved run are read again. Items, whose destination has changed since
+	the run was planned, are skipped. Returns the list of synced sub_paths or None without saved run.
+	"""
+	plan = data.SyncPlan(config)
+	saved = plan.load()
+	if saved == None:
+		return None
+
+	pdata = data.PersistenceData(config)
+	roots = open_roots(config, callback, policy, scan=False)
+	utils.negotiate_hash(config.hash_algorithms, roots)
+	try:
+		sub_paths = [sub_path for sub_path, *_ in saved]
+		for root in roots:
+			root.refresh(sub_paths)
+
+		synclist = []
+		with pdata.deferred_save():
+			for sub_path, src_index, src_saved, dst_saved, done in saved:
+				src_data = roots[src_index]
+				dst_data = roots[1 - src_index]
+				if src_data[sub_path] == dst_data[sub_path]:
+					# Synced, but maybe not saved in pdata before the abort
+					record([pdata], sub_path, src_data[sub_path])
+				elif done or dst_data[sub_path] != dst_saved:
+					logging.warning("Skip '" + sub_path + "': changed since the sync was planned")
+				else:
+					synclist.append((sub_path, src_data, dst_data))
+
+		logging.info("Resume sync with " + str(len(synclist)) + " of " + str(len(saved)) + " items")
+		sync = data.SyncData(synclist, config.bundle_size, backup=config.backup_days > 0, verify=config.verify,
+			priority=config.priority, limits=config.rate_limits)
+		if progress != None:
+			progress.reset(sync.sync_num, sync.sync_bytes)
+		return run(config, pdata, roots, sync, progress, on_error)
+	finally:
+		for root in roots:
+			root.close()
+
+def restore(config, sub_path, stamp=None, callback=None, policy=paramiko.client.RejectPolicy):
+	"""
+	Moves sub_path back from the newest backup (or the backup stamp) of the root, which has it
+
+	The synced state of sub_path is removed from the saved data, so the restored version
+	is treated as a change by the next sync. Returns the stamp of the restored backup or None.
+	"""
+	pdata = data.PersistenceData(config)
+	roots = open_roots(config, callback, policy, scan=False)
+	try:
+		candidates = []
+		for root in roots:
+			for backup in root.backups():
+				if stamp in [None, backup]:
+					candidates.append((backup, root))
+
+		for backup, root in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+			if root.restore(sub_path, backup) != None:
+				with pdata.deferred_save():
+					for saved in [path for path in pdata.data if path == sub_path or path.startswith(sub_path.rstrip('/') + '/')]:
+						pdata.remove(saved)
+				return backup
+		return None
+	finally:
+		for root in roots:
+			root.close()
+
+def dry_run(config, operations=False, callback=None, policy=paramiko.client.RejectPolicy):
+	"""
+	Reads both roots and returns the estimated costs of syncing all changes without conflict (see estimate.estimate)
+
+	Nothing is written to the roots, the saved data or the saved listings and no file is hashed, files which
+	would be hashed to find only changed mtimes are counted as costs. So are conflicts with the same attributes
+	on both sides ('compared conflicts'), which a sync hashes before and resolves if the content is the same.
+	The links to remote roots are measured with a small probe from /dev/zero, which is written to /dev/null.
+	"""
+	pdata = data.PersistenceData(config, read_only=True)
+	roots = open_roots(config, callback, policy, save_listing=False)
+	try:
+		utils.negotiate_hash(config.hash_algorithms, roots)
+		synclist = []
+		conflicts = 0
+		compared = []
+		for sub_path, change in utils.iter_changes(pdata, roots[0], roots[1], config.paths, hash_conflicts=False):
+			if change is utils.ChangeType.FIRST:
+				synclist.append((sub_path, roots[0], roots[1]))
+			elif change is utils.ChangeType.SECOND:
+				synclist.append((sub_path, roots[1], roots[0]))
+			elif change is utils.ChangeType.CONFLICT:
+				if roots[0][sub_path] == roots[1][sub_path] and isinstance(roots[0][sub_path], data.DataFileType):
+					compared.append(sub_path)
+				else:
+					conflicts += 1
+
+		sync = data.SyncData(synclist, config.bundle_size, verify_mtime=False, verify=config.verify, limits=config.rate_limits)
+		links = dict((root, root.measure_link()) for root in roots if isinstance(root, data.SSHData))
+		report = estimate.estimate(sync, links, operations)
+		report['conflicts'] = conflicts
+		report['compared conflicts'] = len(compared)
+		report['compared bytes'] = sum(roots[0][sub_path].size for sub_path in compared)
+		report['seconds'] += report['compared bytes'] / estimate.HASH_RATE
+		return report
+	finally:
+		for root in roots:
+			root.close(save=False)
@@ -1,5 +1,19 @@
 import twosync
+import concurrent.futures
+import errno
 import hashlib
+import itertools
+import logging
+import operator
+import os
+import threading
+import time
+from enum import Enum
+
+ChangeType = Enum('ChangeType', 'NONE FIRST SECOND CONFLICT')
+
+# Paths, which are compared at once by iter_changes
+_chunk_paths = 1024
 
 def log_and_raise(msg, e=None):
 	"""
@@ -25,46 +39,418 @@ class ExitError(Exception):
 	def __str__(self):
 		return repr(self.value)
 
-def get_hash(file):
+# Hash algorithms for the content of files: name -> (hashlib like constructor, command for the remote side)
+HASH_ALGORITHMS = {
+	'sha1': (hashlib.sha1, 'sha1sum'),
+	'sha256': (hashlib.sha256, 'sha256sum'),
+	'md5': (hashlib.md5, 'md5sum'),
+	'blake2b': (hashlib.blake2b, 'b2sum'),
+}
+
+# Fast non-cryptographic hash, only if the optional package xxhash is installed
+HASH_OPTIONAL = ['xxh64']
+try:
+	import xxhash
+	HASH_ALGORITHMS['xxh64'] = (xxhash.xxh64, 'xxh64sum')
+except ImportError:
+	pass
+
+def get_hash(file, algorithm='sha1'):
 	"""
-	Returns the SHA1 hash of a file
+	Returns the hash of a file (SHA1 by default)
 	"""
-	_config_hash = hashlib.sha1()
-	
+	_config_hash = HASH_ALGORITHMS[algorithm][0]()
+
 	with open(file, 'rb') as f:
-		_config_hash.update(f.read())
+		for block in iter(lambda: f.read(1024 * 1024), b''):
+			_config_hash.update(block)
 	return _config_hash.hexdigest()
 
-def get_str_hash(content):
+def get_str_hash(content, algorithm='sha1'):
 	"""
-	Returns the SHA1 hash of content
+	Returns the hash of content (SHA1 by default)
 	"""
-	_config_hash = hashlib.sha1()
+	_config_hash = HASH_ALGORITHMS[algorithm][0]()
 	_config_hash.update(content.encode())
 	return _config_hash.hexdigest()
 
-def find_changes(pdata, fsdata_1, fsdata_2):
-	changes_data1 = set([f for (f, *_) in (pdata.data.items() ^ fsdata_1.data.items())])
-	changes_data2 = set([f for (f, *_) in (pdata.data.items() ^ fsdata_2.data.items())])
-	conflicts = changes_data1 & changes_data2
-	changes = changes_data1 | changes_data2
-
-	# Remove conflicts on pdata, if fsdata's has no conflict
-	remove = set()
-	for conflict in conflicts:
-		if isinstance(fsdata_1[conflict], twosync.data.DataNoneType) and isinstance(fsdata_2[conflict], twosync.data.DataNoneType):
-			pdata.remove(conflict)
-			remove.add(conflict)
-		elif fsdata_1[conflict] == fsdata_2[conflict]:
-			if isinstance(fsdata_1[conflict], twosync.data.DataFileType):
-				if fsdata_1.get_hash(conflict) == fsdata_2.get_hash(conflict):
-					pdata.add_file(conflict, fsdata_1[conflict].mode, fsdata_1[conflict].mtime, fsdata_1[conflict].size)
-					remove.add(conflict)
-			if isinstance(fsdata_1[conflict], twosync.data.DataFolderType):
-				pdata.add_folder(conflict, fsdata_1[conflict].mode)
-				remove.add(conflict)
-
-	conflicts -= remove
-	changes -= remove
-
-	return changes, conflicts
\ No newline at end of file
+def data_regions(f, size):
+	"""
+	Yields tuples (offset, length) with the data regions of the open file f, holes are skipped
+
+	Uses SEEK_DATA/SEEK_HOLE. If they are not supported (or f is no local file), the whole file is one region.
+	"""
+	try:
+		fd = f.fileno()
+	except AttributeError:
+		fd = None
+
+	if fd == None or not hasattr(os, 'SEEK_DATA'):
+		yield 0, size
+		return
+
+	offset = 0
+	while offset < size:
+		try:
+			start = os.lseek(fd, offset, os.SEEK_DATA)
+		except OSError as e:
+			if e.errno == errno.ENXIO:
+				# Only a hole until the end
+				return
+			if offset == 0 and e.errno in [errno.EINVAL, errno.EOPNOTSUPP]:
+				yield 0, size
+				return
+			raise
+		end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+		if start >= end:
+			return
+		yield start, end - start
+		offset = end
+
+def copy_sparse(src, dst, size, callback=None, block_size=1024 * 1024, digest=None, limiter=None):
+	"""
+	Copies size bytes from the open file src to the new, empty file dst and keeps holes
+
+	Only the data regions of src are read and blocks with only zeros are not written, dst gets holes there.
+	dst can be a local file or a paramiko SFTPFile, src too (without detection of the data regions).
+	callback(transferred, total) is called after every block.
+	digest is an optional hash object (like hashlib.sha1()), which is updated with the whole content (holes as zeros).
+	limiter is an optional RateLimiter, every read block is taken from it.
+	"""
+	def hash_zeros(offset, end):
+		while offset < end:
+			digest.update(bytes(min(block_size, end - offset)))
+			offset += block_size
+
+	written = 0
+	hashed = 0
+	for offset, length in data_regions(src, size):
+		if digest != None:
+			hash_zeros(hashed, offset)
+		src.seek(offset)
+		while length > 0:
+			block = src.read(min(block_size, length))
+			if len(block) == 0:
+				break
+			if limiter != None:
+				limiter.consume(len(block))
+			if digest != None:
+				digest.update(block)
+			if block.count(0) != len(block):
+				if dst.tell() != offset:
+					dst.seek(offset)
+				dst.write(block)
+				written = offset + len(block)
+			offset += len(block)
+			length -= len(block)
+			hashed = offset
+			if callback != None:
+				callback(offset, size)
+
+	if digest != None:
+		hash_zeros(hashed, size)
+	# A hole at the end is made by the size of the file
+	if written < size:
+		dst.flush()
+		dst.truncate(size)
+	if callback != None:
+		callback(size, size)
+
+class HashReader(object):
+	"""
+	Wraps the open file f and updates digest with everything, which is read
+	"""
+	def __init__(self, f, digest):
+		self._file = f
+		self.digest = digest
+
+	def read(self, size=-1):
+		block = self._file.read(size)
+		self.digest.update(block)
+		return block
+
+class RateLimiter(object):
+	"""
+	Token bucket, which limits the bytes per second of all transfers, which share it (thread safe)
+
+	schedule is a list of tuples (start, end, rate) with the minutes of the day, rate is in bytes per second.
+	The first tuple, whose time range contains the current time, is used. start None is valid all day,
+	an end before the start is over midnight. Without matching tuple (or with rate 0) nothing is limited.
+	"""
+	def __init__(self, schedule):
+		self._schedule = schedule
+		self._lock = threading.Lock()
+		self._tokens = 0.0
+		self._time = time.monotonic()
+
+	def rate(self, now=None):
+		"""
+		Returns the rate at now (a time.struct_time, default the current local time). 0 if not limited
+		"""
+		if now == None:
+			now = time.localtime()
+		minute = now.tm_hour * 60 + now.tm_min
+		for start, end, rate in self._schedule:
+			if start == None or start <= minute < end or (end < start and (minute >= start or minute < end)):
+				return rate
+		return 0
+
+	def consume(self, size):
+		"""
+		Takes size bytes from the bucket and waits, until they are allowed by the rate
+		"""
+		rate = self.rate()
+		if rate == 0:
+			return
+		with self._lock:
+			now = time.monotonic()
+			# Up to one second of unused rate can be used at once
+			self._tokens = min(self._tokens + (now - self._time) * rate, rate) - size
+			self._time = now
+			wait = -self._tokens / rate
+		if wait > 0:
+			time.sleep(wait)
+
+class RateReader(object):
+	"""
+	Wraps the open file f and takes everything, which is read, from the RateLimiter limiter
+	"""
+	def __init__(self, f, limiter):
+		self._file = f
+		self._limiter = limiter
+
+	def read(self, size=-1):
+		block = self._file.read(size)
+		self._limiter.consume(len(block))
+		return block
+
+def negotiate_hash(algorithms, roots):
+	"""
+	Sets the first algorithm of algorithms, which is supported by all roots, as hash_algorithm of the roots
+
+	Returns the name of the algorithm.
+	"""
+	for algorithm in algorithms:
+		if all(root.supports_hash(algorithm) for root in roots):
+			logging.info("Use hash algorithm: '" + algorithm + "'")
+			for root in roots:
+				root.hash_algorithm = algorithm
+			return algorithm
+	log_and_raise("No hash algorithm of '" + "', '".join(algorithms) + "' is supported by all roots")
+
+def hash_parallel(datas, sub_paths):
+	"""
+	Returns a list with the result of get_hashes(sub_paths) of every root of datas, all roots are hashed at the same time
+	"""
+	if len(sub_paths) == 0:
+		return [dict() for _ in datas]
+	with concurrent.futures.ThreadPoolExecutor(len(datas)) as pool:
+		futures = [pool.submit(data.get_hashes, sub_paths) for data in datas]
+		return [future.result() for future in futures]
+
+def with_parents(synclist):
+	"""
+	Returns a set with the sub_paths of synclist (tuples starting with the sub_path) and all their parent directories
+	"""
+	sub_paths = set()
+	for sub_path, *_ in synclist:
+		sub_paths.add(sub_path)
+		parent = sub_path.rstrip('/').rsplit('/', 1)[0] + '/'
+		while parent != '/' and parent not in sub_paths:
+			sub_paths.add(parent)
+			parent = parent[:-1].rsplit('/', 1)[0] + '/'
+	return sub_paths
+
+def in_paths(sub_path, paths):
+	"""
+	Returns True if sub_path is inside one of paths (directories with a final /) or is a parent directory of them
+
+	Without paths everything is inside.
+	"""
+	if len(paths) == 0:
+		return True
+	return sub_path.startswith(tuple(paths)) or (sub_path.endswith('/') and any(path.startswith(sub_path) for path in paths))
+
+def _chunks(iterable):
+	"""
+	Yields tuples with up to _chunk_paths items of iterable
+	"""
+	iterator = iter(iterable)
+	while True:
+		chunk = tuple(itertools.islice(iterator, _chunk_paths))
+		if len(chunk) == 0:
+			return
+		yield chunk
+
+def _changed_in(paths, saved, data):
+	"""
+	Returns a tuple with the number of paths, which are in the dictionary data, and a list of the paths,
+	whose value in data isn't the one of saved (same order as paths)
+
+	All paths are looked up and compared at once (without a python call per path).
+	"""
+	values = None
+	# itemgetter returns a single value instead of a tuple for one path
+	if len(paths) > 1:
+		try:
+			values = operator.itemgetter(*paths)(data)
+			found = len(paths)
+		except KeyError:
+			pass
+	if values == None:
+		values = tuple(map(data.get, paths))
+		found = len(paths) - values.count(None)
+	if values == saved:
+		return found, []
+	return found, list(itertools.compress(paths, map(operator.ne, values, saved)))
+
+def iter_changes(pdata, fsdata_1, fsdata_2, paths=(), hash_conflicts=True):
+	"""
+	Yields a tuple (path, ChangeType) for every changed path of pdata, fsdata_1 and fsdata_2
+
+	The saved paths are compared in chunks, which are looked up and compared in both roots at once.
+	New paths of a root are only searched, if the number of its paths shows, that there are any.
+	No sorted copies or sets of all paths are built, the memory grows only with the changes.
+	The changed paths of pdata are yielded in its order while they are found, the new paths sorted afterwards.
+	Conflicts, where both sides have changed in the same way, are resolved on pdata (after the walk) and not yielded.
+	Conflicting files with the same attributes on both sides are hashed together (both sides in parallel),
+	with hash_conflicts=False they are not hashed and yielded as ChangeType.CONFLICT.
+	With paths (directories with a final /) only the paths inside them and their parent directories are compared,
+	the other saved paths of pdata are left as they are.
+	If all three datas keep digests (see BasicData.keep_digests), the root or the paths with the same digest
+	on all sides are skipped, only the entries of skipped paths and their parent directories are compared.
+	"""
+	datas = [pdata.data, fsdata_1.data, fsdata_2.data]
+	# Directories, which are compared without their content
+	dirs = set()
+	digests = [pdata.digests, fsdata_1.digests, fsdata_2.digests]
+	if None not in digests:
+		unchanged = [path for path in (paths if len(paths) > 0 else ['/']) if digests[0].get(path, 0) == digests[1].get(path, 0) == digests[2].get(path, 0)]
+		if len(paths) == 0 and len(unchanged) > 0:
+			return
+		paths = [path for path in paths if path not in unchanged]
+		dirs = set('/'.join(path.split('/')[:pos]) + '/' for path in unchanged for pos in range(2, path.count('/') + 1))
+
+	def inside(path):
+		return (len(paths) > 0 and in_paths(path, paths)) or path in dirs
+
+	if len(paths) == 0 and len(dirs) == 0:
+		items = datas[0].items()
+	else:
+		items = ((path, saved) for path, saved in datas[0].items() if inside(path))
+
+	# Number of paths of pdata, which are found in the roots
+	found = [0, 0]
+	# Paths changed on both sides, resolved after the walk (pdata can't change while it's walked)
+	conflicts = []
+	for chunk in _chunks(items):
+		sub_paths, saved = zip(*chunk)
+		found_1, changed_1 = _changed_in(sub_paths, saved, datas[1])
+		found_2, changed_2 = _changed_in(sub_paths, saved, datas[2])
+		found[0] += found_1
+		found[1] += found_2
+		both = set(changed_1).intersection(changed_2)
+		conflicts.extend(path for path in changed_1 if path in both)
+		for path, change in [(path, ChangeType.FIRST) for path in changed_1] + [(path, ChangeType.SECOND) for path in changed_2]:
+			if path not in both:
+				yield path, change
+
+	new = set()
+	for data, count in zip(datas[1:], found):
+		if len(paths) > 0 or len(dirs) > 0:
+			new.update(path for path in data if path not in datas[0] and inside(path))
+		elif len(data) > count:
+			for chunk in _chunks(data):
+				new.update(set(chunk).difference(datas[0]))
+	for path in sorted(new):
+		change = _change_type(path in datas[1], path in datas[2])
+		if change is ChangeType.CONFLICT:
+			conflicts.append(path)
+		else:
+			yield path, change
+
+	if len(conflicts) == 0:
+		return
+	with pdata.deferred_save():
+		for path, change in _resolve_candidates(pdata, fsdata_1, fsdata_2, conflicts, hash_conflicts):
+			if change is not ChangeType.NONE:
+				yield path, change
+
+def changes_of(pdata, fsdata_1, fsdata_2, sub_paths):
+	"""
+	Returns a dictionary with the ChangeType of every path of sub_paths, with the same rules as iter_changes
+
+	Only these paths are compared (like after a sync), conflicts are resolved on pdata.
+	"""
+	changes = dict()
+	conflicts = []
+	for path in sub_paths:
+		changes[path] = _change_type(pdata[path] != fsdata_1[path], pdata[path] != fsdata_2[path])
+		if changes[path] is ChangeType.CONFLICT:
+			conflicts.append(path)
+	with pdata.deferred_save():
+		changes.update(_resolve_candidates(pdata, fsdata_1, fsdata_2, conflicts))
+	return changes
+
+def _change_type(changed_1, changed_2):
+	"""
+	Returns the ChangeType of a path, which has changed on the first and/or second side (without resolving conflicts)
+	"""
+	if changed_1 and changed_2:
+		return ChangeType.CONFLICT
+	elif changed_1:
+		return ChangeType.FIRST
+	elif changed_2:
+		return ChangeType.SECOND
+	return ChangeType.NONE
+
+def _resolve_candidates(pdata, fsdata_1, fsdata_2, conflicts, hash_files=True):
+	"""
+	Yields a tuple (path, ChangeType) for every path of conflicts, ChangeType.NONE if it's resolved on pdata
+
+	Files with the same attributes on both sides are hashed first (both sides in parallel),
+	with hash_files=False they stay conflicts.
+	"""
+	hashes = None
+	if hash_files:
+		same = [path for path in conflicts if fsdata_1[path] == fsdata_2[path] and isinstance(fsdata_1[path], twosync.data.DataFileType)]
+		if len(same) > 0:
+			logging.info("Compare hashes of " + str(len(same)) + " files changed the same way on both sides")
+		hashes = hash_parallel([fsdata_1, fsdata_2], same)
+	for path in conflicts:
+		if _resolve_conflict(pdata, fsdata_1, fsdata_2, path, hashes):
+			yield path, ChangeType.NONE
+		else:
+			yield path, ChangeType.CONFLICT
+
+def _resolve_conflict(pdata, fsdata_1, fsdata_2, conflict, hashes=None):
+	"""
+	Updates pdata if both fsdata's has changed to the same. Returns True if the conflict is resolved
+
+	hashes is a list with the dictionaries of hashes of both sides (from get_hashes), which is needed for files.
+	Files, which can't be hashed, are not resolved.
+	"""
+	if isinstance(fsdata_1[conflict], twosync.data.DataNoneType) and isinstance(fsdata_2[conflict], twosync.data.DataNoneType):
+		pdata.remove(conflict)
+		return True
+	elif fsdata_1[conflict] == fsdata_2[conflict]:
+		if isinstance(fsdata_1[conflict], twosync.data.DataFileType) and hashes != None:
+			if conflict in hashes[0] and hashes[0][conflict] == hashes[1].get(conflict):
+				pdata.add_file(conflict, fsdata_1[conflict].mode, fsdata_1[conflict].mtime, fsdata_1[conflict].size)
+				return True
+		if isinstance(fsdata_1[conflict], twosync.data.DataFolderType):
+			pdata.add_folder(conflict, fsdata_1[conflict].mode)
+			return True
+	return False
+
+def find_changes(pdata, fsdata_1, fsdata_2, paths=()):
+	changes = set()
+	conflicts = set()
+	for path, change in iter_changes(pdata, fsdata_1, fsdata_2, paths):
+		if change is ChangeType.NONE:
+			continue
+		changes.add(path)
+		if change is ChangeType.CONFLICT:
+			conflicts.add(path)
+
+	return changes, conflicts
@@ -0,0 +1,381 @@
+#! /usr/bin/env python3
+"""
+Benchmarks SSHData over an emulated WAN link, without a real ssh server
+
+An in-process paramiko server (SFTP and exec) serves a local directory. Its connection goes through a relay,
+which delays every chunk by half of the round trip time (with jitter), caps the bandwidth of both directions
+and can drop the connection after some seconds. EmulatedSSHData plugs this link into SSHData (also for reconnects).
+Reports wall time, round trips and transfered bytes of connect, sync, scan and hash for every round trip time.
+"""
+import argparse
+import errno
+import os
+import queue
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, SFTP_OK
+
+# Config and plans are written to ~/.twosync, which is a temporary directory here
+home = tempfile.mkdtemp(prefix='2sync_wan_')
+os.environ['HOME'] = home
+os.mkdir(os.path.join(home, '.twosync'))
+
+from twosync import config, data, runner
+
+parser = argparse.ArgumentParser(description='benchmark of 2sync over an emulated WAN link')
+parser.add_argument('--rtts', default='0.05,0.1,0.3', help='comma separated round trip times in seconds (default: 0.05,0.1,0.3)')
+parser.add_argument('--rate', type=int, default=1024, help='bandwidth of each direction in KiB per second (0 = not limited, default: 1024)')
+parser.add_argument('--jitter', type=float, default=0.0, help='maximal random extra delay of a chunk in seconds (default: 0)')
+parser.add_argument('--drop-after', type=float, default=None, help='drop every connection of the sync after this number of seconds (default: never)')
+parser.add_argument('--dirs', type=int, default=4, help='number of directories (default: 4)')
+parser.add_argument('--files', type=int, default=8, help='number of files per directory (default: 8)')
+parser.add_argument('--size', type=int, default=16384, help='size of every file in bytes (default: 16384)')
+parser.add_argument('--bundle-size', type=int, default=0, help='bundle size of the config (default: 0)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the jitter (default: 0)')
+
+class Link(object):
+	"""
+	Emulated network between the client and the server of every connection
+
+	Every chunk is delivered after half of rtt, a random jitter (up to jitter seconds) and its time at rate
+	(bytes per second, 0 = not limited). The order of the chunks is kept. With drop_after, every connection
+	is closed after this number of seconds, while dropping is set (only the sync reconnects). Counts the round trips (client sends after it received something),
+	the bytes of both directions, the connections and the drops.
+	"""
+	def __init__(self, rtt, rate=0, jitter=0.0, drop_after=None, seed=0):
+		self.rtt = rtt
+		self.rate = rate
+		self.jitter = jitter
+		self.drop_after = drop_after
+		self.dropping = False
+		self._random = random.Random(seed)
+		self._host_key = paramiko.RSAKey.generate(2048)
+		self._last = 'down'
+		self.round_trips = 0
+		self.bytes = {'up': 0, 'down': 0}
+		self.connections = 0
+		self.drops = 0
+
+	def counters(self):
+		"""
+		Returns a tuple with the round trips, the bytes up and the bytes down
+		"""
+		return self.round_trips, self.bytes['up'], self.bytes['down']
+
+	def connect(self):
+		"""
+		Returns a new authenticated paramiko.Transport to a new server over this link
+		"""
+		client, relay_client = socket.socketpair()
+		relay_server, server = socket.socketpair()
+		self.connections += 1
+		sockets = [client, relay_client, relay_server, server]
+		started = time.monotonic()
+		for direction, src, dst in [('up', relay_client, relay_server), ('down', relay_server, relay_client)]:
+			chunks = queue.Queue()
+			threading.Thread(target=self._receive, args=(direction, src, chunks, sockets, started), daemon=True).start()
+			threading.Thread(target=self._deliver, args=(dst, chunks), daemon=True).start()
+
+		transport = paramiko.Transport(server)
+		transport.add_server_key(self._host_key)
+		transport.set_subsystem_handler('sftp', SFTPServer, _SFTPServer)
+		threading.Thread(target=transport.start_server, kwargs={'server': _Server()}, daemon=True).start()
+
+		transport = paramiko.Transport(client)
+		transport.connect()
+		transport.auth_none('2sync')
+		return transport
+
+	def _receive(self, direction, src, chunks, sockets, started):
+		# Time, when the link of this direction is free again (bandwidth)
+		free = time.monotonic()
+		delivered = 0.0
+		while True:
+			try:
+				chunk = src.recv(65536)
+			except OSError:
+				chunk = b''
+			if self.dropping and self.drop_after != None and time.monotonic() - started > self.drop_after:
+				self.drops += 1
+				for sock in sockets:
+					try:
+						sock.shutdown(socket.SHUT_RDWR)
+					except OSError:
+						pass
+				chunk = b''
+			if len(chunk) == 0:
+				chunks.put((0, b''))
+				return
+
+			if direction == 'up' and self._last == 'down':
+				self.round_trips += 1
+			self._last = direction
+			self.bytes[direction] += len(chunk)
+
+			now = time.monotonic()
+			free = max(free, now)
+			if self.rate > 0:
+				free += len(chunk) / self.rate
+			delivered = max(delivered, free + self.rtt / 2 + self._random.uniform(0, self.jitter))
+			chunks.put((delivered, chunk))
+
+	def _deliver(self, dst, chunks):
+		while True:
+			deliver, chunk = chunks.get()
+			if len(chunk) == 0:
+				try:
+					dst.shutdown(socket.SHUT_WR)
+				except OSError:
+					pass
+				return
+			time.sleep(max(0, deliver - time.monotonic()))
+			try:
+				dst.sendall(chunk)
+			except OSError:
+				return
+
+def _set_attr(path, attr):
+	# SFTPServer.set_file_attr can't change the size of a file
+	if attr._flags & attr.FLAG_SIZE:
+		os.truncate(path, attr.st_size)
+		attr._flags &= ~attr.FLAG_SIZE
+	SFTPServer.set_file_attr(path, attr)
+
+def _sftp_errors(function):
+	"""
+	Returns function, which returns the SFTP error code of an OSError instead of raising it
+	"""
+	def wrapper(*args):
+		try:
+			return function(*args)
+		except OSError as e:
+			return SFTPServer.convert_errno(e.errno)
+	return wrapper
+
+class _Handle(SFTPHandle):
+	@_sftp_errors
+	def stat(self):
+		return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+	@_sftp_errors
+	def chattr(self, attr):
+		_set_attr(self.filename, attr)
+		return SFTP_OK
+
+class _SFTPServer(SFTPServerInterface):
+	"""
+	SFTP server for the local filesystem (absolute paths, like the remote side of SSHData)
+	"""
+	@_sftp_errors
+	def list_folder(self, path):
+		entries = []
+		for name in os.listdir(path):
+			attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+			attr.filename = name
+			entries.append(attr)
+		return entries
+
+	@_sftp_errors
+	def stat(self, path):
+		return SFTPAttributes.from_stat(os.stat(path))
+
+	@_sftp_errors
+	def lstat(self, path):
+		return SFTPAttributes.from_stat(os.lstat(path))
+
+	@_sftp_errors
+	def open(self, path, flags, attr):
+		fd = os.open(path, flags, 0o666)
+		if flags & os.O_CREAT and attr != None:
+			attr._flags &= ~attr.FLAG_PERMISSIONS
+			_set_attr(path, attr)
+		if flags & os.O_APPEND:
+			mode = 'ab'
+		elif flags & os.O_RDWR:
+			mode = 'r+b'
+		elif flags & os.O_WRONLY:
+			mode = 'wb'
+		else:
+			mode = 'rb'
+		handle = _Handle(flags)
+		handle.filename = path
+		handle.readfile = handle.writefile = os.fdopen(fd, mode)
+		return handle
+
+	@_sftp_errors
+	def remove(self, path):
+		os.remove(path)
+		return SFTP_OK
+
+	@_sftp_errors
+	def rename(self, old_path, new_path):
+		if os.path.exists(new_path):
+			return SFTPServer.convert_errno(errno.EEXIST)
+		os.rename(old_path, new_path)
+		return SFTP_OK
+
+	@_sftp_errors
+	def posix_rename(self, old_path, new_path):
+		os.rename(old_path, new_path)
+		return SFTP_OK
+
+	@_sftp_errors
+	def mkdir(self, path, attr):
+		os.mkdir(path)
+		if attr != None:
+			_set_attr(path, attr)
+		return SFTP_OK
+
+	@_sftp_errors
+	def rmdir(self, path):
+		os.rmdir(path)
+		return SFTP_OK
+
+	@_sftp_errors
+	def chattr(self, path, attr):
+		_set_attr(path, attr)
+		return SFTP_OK
+
+class _Server(paramiko.ServerInterface):
+	"""
+	Accepts everyone and runs exec requests with sh on the local machine
+	"""
+	def get_allowed_auths(self, username):
+		return 'none'
+
+	def check_auth_none(self, username):
+		return paramiko.AUTH_SUCCESSFUL
+
+	def check_channel_request(self, kind, chanid):
+		return paramiko.OPEN_SUCCEEDED
+
+	def check_channel_exec_request(self, channel, command):
+		threading.Thread(target=_execute, args=(channel, command.decode()), daemon=True).start()
+		return True
+
+def _execute(channel, command):
+	process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+	def stdin():
+		try:
+			for block in iter(lambda: channel.recv(32768), b''):
+				process.stdin.write(block)
+				process.stdin.flush()
+			process.stdin.close()
+		except OSError:
+			pass
+
+	def stderr():
+		for block in iter(lambda: process.stderr.read1(32768), b''):
+			channel.sendall_stderr(block)
+
+	threading.Thread(target=stdin, daemon=True).start()
+	errors = threading.Thread(target=stderr, daemon=True)
+	errors.start()
+	for block in iter(lambda: process.stdout.read1(32768), b''):
+		channel.sendall(block)
+	errors.join()
+	channel.send_exit_status(process.wait())
+	channel.shutdown_write()
+	channel.close()
+
+class EmulatedSSHData(data.SSHData):
+	"""
+	SSHData, which is connected over a Link instead of the network
+	"""
+	def __init__(self, link, path, config, callback=None, scan=True):
+		self._link = link
+		super().__init__(path, config, callback, paramiko.client.AutoAddPolicy, scan)
+
+	def _connect(self):
+		self._transport = self._link.connect()
+		self._sftp_client = self.open_sftp()
+		self._sftp_client.get_channel().settimeout(10)
+
+def build(root):
+	"""
+	Creates the tree of the arguments in root and returns its number of files
+	"""
+	rand = random.Random(args.seed)
+	for number in range(args.dirs):
+		sub_dir = os.path.join(root, 'dir_%d' % number)
+		os.makedirs(sub_dir)
+		for file_number in range(args.files):
+			with open(os.path.join(sub_dir, 'file_%d' % file_number), 'wb') as f:
+				f.write(bytes(rand.getrandbits(8) for _ in range(args.size)))
+	return args.dirs * args.files
+
+def measure(link, function):
+	"""
+	Returns a tuple with the result of function, its time in seconds and the round trips, bytes up and bytes down
+	"""
+	before = link.counters()
+	start = time.monotonic()
+	result = function()
+	seconds = time.monotonic() - start
+	return (result, seconds) + tuple(after - before for after, before in zip(link.counters(), before))
+
+def run(rtt, local_root, remote_root):
+	"""
+	Returns a list with the name, seconds, round trips, bytes up and bytes down of every step
+	"""
+	link = Link(rtt, args.rate * 1024, args.jitter, args.drop_after, args.seed)
+	cfg = config.Config('wan')
+	results = []
+
+	local, *result = measure(link, lambda: data.FSData(local_root, cfg))
+	remote, *result = measure(link, lambda: EmulatedSSHData(link, 'ssh://emulated/' + remote_root, cfg))
+	results.append(['connect'] + result)
+
+	sync = data.SyncData([(sub_path, local, remote) for sub_path in local.data], cfg.bundle_size)
+	link.dropping = True
+	try:
+		synced, *result = measure(link, lambda: runner.run(cfg, data.BasicData(), [local, remote], sync))
+	finally:
+		link.dropping = False
+	results.append(['sync'] + result)
+	if len(synced) != sync.sync_num:
+		print('  %d of %d items synced' % (len(synced), sync.sync_num), file=sys.stderr)
+
+	_, *result = measure(link, lambda: remote.rescan(cfg))
+	results.append(['scan'] + result)
+
+	files = [sub_path for sub_path in remote.data if not sub_path.endswith('/')]
+	hashes, *result = measure(link, lambda: remote.get_hashes(files))
+	results.append(['hash'] + result)
+	if len(hashes) != len(files):
+		print('  %d of %d files hashed' % (len(hashes), len(files)), file=sys.stderr)
+
+	remote.close()
+	paramiko.client.SSHClient.close(remote)
+	if link.drops > 0:
+		results.append(['(%d drops)' % link.drops, 0, 0, 0, 0])
+	return results
+
+args = parser.parse_args()
+local_root = os.path.join(home, 'local')
+remote_root = os.path.join(home, 'remote')
+os.mkdir(local_root)
+with open(os.path.join(home, '.twosync', 'wan'), 'w') as f:
+	f.write('root = %s\nroot = ssh://emulated/%s\n' % (local_root, remote_root))
+	f.write('bundle size = %d\n' % args.bundle_size)
+
+count = build(local_root)
+print('%d directories, %d files of %d bytes, %s KiB/s' % (args.dirs, count, args.size, args.rate or 'unlimited'))
+try:
+	for rtt in [float(rtt) for rtt in args.rtts.split(',')]:
+		os.mkdir(remote_root)
+		print('rtt %.0f ms' % (rtt * 1000), flush=True)
+		for step, seconds, round_trips, up, down in run(rtt, local_root, remote_root):
+			print('  %-12s %8.2f s %6d round trips %10d bytes up %10d bytes down' % (step, seconds, round_trips, up, down), flush=True)
+		shutil.rmtree(remote_root)
+finally:
+	shutil.rmtree(home)